@@ -2,8 +2,8 @@ import tkinter as tk
 from tkinter import filedialog, messagebox
 from PIL import Image, ImageTk
 import torch
-from torchvision import models, transforms
 import os
+from predictor_core import load_predictor
 
 class WeatherClassifierApp:
     def __init__(self, root):
@@ -20,14 +20,6 @@ class WeatherClassifierApp:
     def setup_model(self):
         # Set up device and model
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.model = models.resnet34(pretrained=False)
-        self.model.fc = torch.nn.Sequential(
-            torch.nn.Dropout(0.5),
-            torch.nn.Linear(self.model.fc.in_features, 512),
-            torch.nn.ReLU(),
-            torch.nn.Dropout(0.3),
-            torch.nn.Linear(512, 4)
-        )
         
         # Load model weights
         model_path = "best_model.pth"
@@ -36,16 +28,7 @@ class WeatherClassifierApp:
             self.root.destroy()
             return
             
-        self.model.load_state_dict(torch.load(model_path, map_location=self.device))
-        self.model.to(self.device)
-        self.model.eval()
-        
-        # Set up image transformation
-        self.transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-        ])
+        self.predictor = load_predictor(model_path, "weather4", self.device)
         
     def create_widgets(self):
         # Create main frame
@@ -108,40 +91,12 @@ class WeatherClassifierApp:
         
     def classify_image(self, image):
         try:
-            # Preprocess image
-            image_tensor = self.transform(image).unsqueeze(0).to(self.device)
-            
-            # Get prediction
-            with torch.no_grad():
-                output = self.model(image_tensor)
-                probabilities = torch.softmax(output, dim=1)[0]
-                
-                # Get class probabilities
-                sunny_snow_prob = probabilities[0].item()
-                cloudy_snow_prob = probabilities[1].item()
-                sunny_no_snow_prob = probabilities[2].item()
-                cloudy_no_snow_prob = probabilities[3].item()
-                
-                # Determine overall prediction
-                snow_prob = sunny_snow_prob + cloudy_snow_prob
-                no_snow_prob = sunny_no_snow_prob + cloudy_no_snow_prob
-                sunny_prob = sunny_snow_prob + sunny_no_snow_prob
-                cloudy_prob = cloudy_snow_prob + cloudy_no_snow_prob
-                
-                # Get main prediction
-                conditions = []
-                if sunny_prob > cloudy_prob:
-                    conditions.append("Sunny")
-                else:
-                    conditions.append("Cloudy")
-                    
-                if snow_prob > no_snow_prob:
-                    conditions.append("with Snow")
-                else:
-                    conditions.append("No Snow")
-                
-                prediction = " ".join(conditions)
-                confidence = max(probabilities).item()
+            # Preprocess and predict
+            result = self.predictor.predict_batch([image])[0]
+            prediction = result["prediction"]
+            confidence = result["confidence"]
+            snow_prob = result["snow_prob"]
+            no_snow_prob = result["no_snow_prob"]
             
             # Update results
             self.prediction_label.config(text=f"Prediction: {prediction}")
@@ -1,9 +1,22 @@
 import sys, os
+import argparse
+import json
+import io
+import time
 import torch
-from torchvision import transforms, models
-from PIL import Image
+from torch.utils.data import Dataset, DataLoader, Sampler
 from tqdm import tqdm
-from db_connect import connect_to_database
+from db_connect import (connect_to_database, stream_rows, stream_camera_rows, count_rows, schema_lock,
+                        ensure_camera_time_index)
+from run_metrics import RunMetrics
+from prediction_cache import PredictionCache, content_hash, perceptual_hash
+from frame_gating import StreamGate, frame_signature, DARK_LABEL
+from file_index import FileIndex, write_csv
+from derivative_store import DerivativeStore
+from embedding_store import EmbeddingStore
+from prediction_rollup import (CREATE_ROLLUP_DAYS_SQL, TOUCHED_DAYS_SQL, RECOMPUTE_DAYS_SQL,
+                               set_index_session_options, lock_rollup, ensure_rollup, ensure_prediction_indexes)
+from predictor_core import load_predictor, get_best_device, list_images, open_image, BACKENDS
 import datetime
 
 class Tee:
@@ -13,7 +26,7 @@ class Tee:
     def write(self, obj):
         timestamped = self._add_timestamp(obj)
         for f in self.files:
-            f.write(obj)
+            f.write(timestamped)
             f.flush()
 
     def flush(self):
@@ -25,139 +38,601 @@ class Tee:
         now = datetime.datetime.now().strftime("[%Y-%m-%d %H:%M:%S] ")
         return ''.join((now + line if line.strip() else line) for line in lines)
 
-log_file = open("initialize.log", "w")
-sys.stdout = Tee(log_file)
-sys.stderr = Tee(log_file)
-
-# --- Model Definition ---
-class MultiTaskResNet(torch.nn.Module):
-    def __init__(self):
-        super(MultiTaskResNet, self).__init__()
-        self.base_model = models.resnet34(pretrained=False)
-
-        for param in self.base_model.parameters():
-            param.requires_grad = False
-        for param in self.base_model.layer4.parameters():
-            param.requires_grad = True
-
-        self.features = torch.nn.Sequential(*list(self.base_model.children())[:-1])
-
-        self.weather_classifier = torch.nn.Sequential(
-            torch.nn.Dropout(0.5),
-            torch.nn.Linear(512, 256),
-            torch.nn.ReLU(),
-            torch.nn.Dropout(0.3),
-            torch.nn.Linear(256, 2)
-        )
-
-        self.snow_classifier = torch.nn.Sequential(
-            torch.nn.Dropout(0.5),
-            torch.nn.Linear(512, 256),
-            torch.nn.ReLU(),
-            torch.nn.Dropout(0.3),
-            torch.nn.Linear(256, 2)
-        )
-
-    def forward(self, x):
-        x = self.features(x)
-        x = torch.flatten(x, 1)
-        return self.weather_classifier(x), self.snow_classifier(x)
-
-# --- Device Selection ---
-def get_best_device():
-    if torch.cuda.is_available():
-        print(f"Using CUDA GPU: {torch.cuda.get_device_name(0)}")
-        return torch.device("cuda:0")
-    elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
-        print("Using Apple Metal (MPS) GPU")
-        return torch.device("mps")
-    elif torch.version.hip is not None and torch.cuda.is_available():
-        print("Using ROCm-compatible AMD GPU")
-        return torch.device("cuda:0")
+def resolve_image_path(file_path, base_path):
+    return os.path.normpath(os.path.join(base_path, file_path.replace("/app", "").lstrip("/")))
+
+# --- Batched Dataset ---
+# Decoding and transforms run inside DataLoader workers, so the model only ever
+# sees full batches. Failures are returned rather than raised so one bad file
+# does not take down a worker.
+#
+# Rows are streamed from the database page by page and handed to the workers as
+# the sampler's "indices". The DataLoader only pulls as many rows as it has
+# batches in flight, and still yields batches in Id order.
+class StreamingRowSampler(Sampler):
+    def __init__(self, rows, metrics=None):
+        self.rows = rows
+        self.metrics = metrics
+
+    def __iter__(self):
+        rows = iter(self.rows)
+        while True:
+            read_start = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            if self.metrics:
+                self.metrics.add_time("db_read", time.perf_counter() - read_start)
+            yield row
+
+#
+# With dedup enabled, each worker hashes the file (by content, or perceptually
+# from a tiny draft decode) and looks it up in the prediction cache first, so
+# duplicates skip both the full decode and the forward pass.
+#
+# In time-series mode rows also carry SiteName, SiteNumber,
+# CameraPositionNumber and UnixTime. Each worker computes a tiny frame signature so dark frames skip the
+# full decode, and the main process can gate near-identical frames.
+class ImageRowDataset(Dataset):
+    def __init__(self, base_path, transform, draft_size=None, dedup="off", cache_path=None, model_version=None,
+                 timeseries=False, dark_threshold=0, file_index=None, derivatives=None):
+        self.base_path = base_path
+        self.transform = transform
+        self.draft_size = draft_size
+        self.dedup = dedup
+        self.cache_path = cache_path
+        self.model_version = model_version
+        self.timeseries = timeseries
+        self.dark_threshold = dark_threshold
+        # With an index of the archive, existence is checked in memory instead of a stat per row
+        self.exists = file_index.exists if file_index else os.path.exists
+        self.derivatives = derivatives
+        # Opened lazily so each worker gets its own SQLite connection
+        self.cache = None
+
+    def __getitem__(self, row):
+        img_id, file_path = row[:2]
+        item = {"id": img_id, "path": file_path, "image": None, "error": None, "key": None, "cached": None,
+                "stream": tuple(row[2:5]), "time": row[5] if len(row) > 5 else None,
+                "signature": None, "dark": False, "derivatives": None}
+        decode_start = time.perf_counter()
+        try:
+            real_path = resolve_image_path(file_path, self.base_path)
+            if not self.exists(real_path):
+                raise FileNotFoundError(f"Missing image: {real_path}")
+
+            source = real_path
+            if self.dedup != "off" or self.timeseries or self.derivatives:
+                # Read once; the hash, signature and full decode all come from memory
+                with open(real_path, "rb") as f:
+                    source = io.BytesIO(f.read())
+
+            if self.dedup != "off":
+                if self.cache is None:
+                    self.cache = PredictionCache(self.cache_path, self.model_version)
+                item["key"] = content_hash(source.getvalue()) if self.dedup == "content" else perceptual_hash(source)
+                item["cached"] = self.cache.get(item["key"])
+                source.seek(0)
+
+            if self.timeseries and item["cached"] is None:
+                item["signature"], brightness = frame_signature(source)
+                item["dark"] = brightness < self.dark_threshold
+                source.seek(0)
+
+            # Missing derivatives are decoded at their own size from the bytes
+            # already in memory. The model input always comes from a decode at
+            # the model's draft size, so predictions do not depend on what is
+            # in the derivative store.
+            needs_model = item["cached"] is None and not item["dark"]
+            if self.derivatives:
+                key = item["key"] if self.dedup == "content" else content_hash(source.getvalue())
+                digest = key.split(":", 1)[1]
+                missing = self.derivatives.missing(digest)
+                if missing:
+                    self.derivatives.save(open_image(source, self.derivatives.draft_size), digest, missing)
+                    source.seek(0)
+
+            if needs_model:
+                item["image"] = self.transform(open_image(source, self.draft_size))
+            if self.derivatives:
+                item["derivatives"] = self.derivatives.paths(digest)
+        except Exception as e:
+            item["error"] = (type(e).__name__, str(e))
+        item["decode_s"] = time.perf_counter() - decode_start
+        return item
+
+def collate_rows(batch):
+    ok = [item for item in batch if item["image"] is not None]
+    return {
+        "ids": [item["id"] for item in ok],
+        "keys": [item["key"] for item in ok],
+        "streams": [item["stream"] for item in ok],
+        "times": [item["time"] for item in ok],
+        "signatures": [item["signature"] for item in ok],
+        "dark": [item["id"] for item in batch if item["dark"] and item["error"] is None],
+        "images": torch.stack([item["image"] for item in ok]) if ok else None,
+        "cached": [(item["id"], item["cached"]) for item in batch if item["cached"] is not None],
+        "failed": [(item["id"], item["path"], item["error"]) for item in batch if item["error"] is not None],
+        "derivatives": [(item["id"], item["derivatives"]) for item in batch
+                        if item["derivatives"] and item["error"] is None],
+        "decode_s": sum(item["decode_s"] for item in batch)
+    }
+
+def predict_batch(predictor, images, metrics=None, embeddings=None, ids=None):
+    # With an embedding store, the pooled features of each image are saved under its Id
+    forward_start = time.perf_counter()
+    if embeddings is not None:
+        predictions, vectors = predictor.predict_batch(images, return_embeddings=True)
     else:
-        print("No GPU available. Falling back to CPU.")
-        return torch.device("cpu")
-
-device = get_best_device()
-
-# --- Load Model ---
-model_path = "best_model.pth"
-model = MultiTaskResNet()
-model.load_state_dict(torch.load(model_path, map_location=device))
-model.to(device)
-model.eval()
-
-# --- Image Preprocessing ---
-transform = transforms.Compose([
-    transforms.Resize((256, 256)),
-    transforms.CenterCrop(224),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                         std=[0.229, 0.224, 0.225])
-])
-
-# --- Database Connection ---
-conn = connect_to_database()
-cursor = conn.cursor()
-
-cursor.execute("""
-IF COL_LENGTH('Images', 'WeatherPrediction') IS NULL
-    ALTER TABLE Images ADD WeatherPrediction NVARCHAR(50);
-IF COL_LENGTH('Images', 'WeatherPredictionPercent') IS NULL
-    ALTER TABLE Images ADD WeatherPredictionPercent FLOAT;
-IF COL_LENGTH('Images', 'SnowPrediction') IS NULL
-    ALTER TABLE Images ADD SnowPrediction NVARCHAR(50);
-IF COL_LENGTH('Images', 'SnowPredictionPercent') IS NULL
-    ALTER TABLE Images ADD SnowPredictionPercent FLOAT;
-""")
-conn.commit()
-
-# --- Prediction & DB Update ---
-cursor.execute("SELECT Id, FilePath FROM Images")
-rows = cursor.fetchall()
-base_path = "/"
-
-print("Starting image prediction run.")
-
-for i, (img_id, file_path) in enumerate(tqdm(rows, desc="Predicting images", file=sys.stdout)):
-    try:
-        real_path = os.path.normpath(os.path.join(base_path, file_path.replace("/app", "").lstrip("/")))
-        if not os.path.exists(real_path):
-            raise FileNotFoundError(f"Missing image: {real_path}")
-
-        image = Image.open(real_path).convert("RGB")
-        image_tensor = transform(image).unsqueeze(0).to(device)
-
-        with torch.no_grad():
-            weather_out, snow_out = model(image_tensor)
-            weather_probs = torch.softmax(weather_out, dim=1)[0]
-            snow_probs = torch.softmax(snow_out, dim=1)[0]
-
-            weather_idx = torch.argmax(weather_probs).item()
-            snow_idx = torch.argmax(snow_probs).item()
-
-            weather_label = ['Sunny', 'Cloudy'][weather_idx]
-            snow_label = ['No Snow', 'Snow'][snow_idx]
-
-            weather_conf = weather_probs[weather_idx].item() * 100
-            snow_conf = snow_probs[snow_idx].item() * 100
+        predictions = predictor.predict_batch(images)
+    forward_seconds = time.perf_counter() - forward_start
+    if metrics:
+        metrics.add_time("forward", forward_seconds, len(predictions))
+    # Latency is the per-image share of the batch forward pass.
+    latency_ms = forward_seconds * 1000 / len(predictions)
+
+    results = []
+    for p in predictions:
+        results.append((p["weather"], p["weather_prob"] * 100, p["snow"], p["snow_prob"] * 100, latency_ms))
+
+    if embeddings is not None:
+        embed_start = time.perf_counter()
+        embeddings.put(ids, vectors.numpy())
+        if metrics:
+            metrics.add_time("embed_write", time.perf_counter() - embed_start, len(ids))
+    return results
+
+# --- Checkpointing ---
+# Rows are processed in Id order, so the highest Id whose predictions have been
+# committed is enough to resume a killed run.
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f).get("last_id")
+
+def save_checkpoint(path, last_id):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"last_id": last_id}, f)
+    os.replace(tmp_path, path)
+
+# --- Bulk Prediction Writer ---
+# Predictions are buffered and written as multi-row INSERTs into a session temp
+# table, then applied to Images with a single joined UPDATE and committed per
+# flush. SQL Server caps a statement at 2100 parameters, so inserts are chunked.
+STAGING_ROWS_PER_INSERT = 250
+
+class PredictionWriter:
+    def __init__(self, conn, model_version, flush_size=5000, checkpoint_path=None, metrics=None, rollup=False):
+        self.conn = conn
+        self.rollup = rollup
+        self.metrics = metrics
+        self.cursor = conn.cursor()
+        self.model_version = model_version
+        self.flush_size = flush_size
+        self.checkpoint_path = checkpoint_path
+        self.last_done_id = None
+        self.buffer = []
+        self.derivative_buffer = []
+        self.written = 0
+        self.flush_seconds = 0.0
+
+        self.cursor.execute("""
+        IF OBJECT_ID('tempdb..#PredictionStaging') IS NOT NULL
+            DROP TABLE #PredictionStaging;
+        CREATE TABLE #PredictionStaging (
+            Id BIGINT PRIMARY KEY,
+            WeatherPrediction NVARCHAR(50),
+            WeatherPredictionPercent FLOAT,
+            SnowPrediction NVARCHAR(50),
+            SnowPredictionPercent FLOAT,
+            ModelVersion NVARCHAR(64),
+            PredictedAt DATETIME2,
+            InferenceMs FLOAT
+        );
+        IF OBJECT_ID('tempdb..#DerivativeStaging') IS NOT NULL
+            DROP TABLE #DerivativeStaging;
+        CREATE TABLE #DerivativeStaging (
+            Id BIGINT PRIMARY KEY,
+            ThumbnailPath NVARCHAR(260),
+            PreviewPath NVARCHAR(260)
+        );
+        """)
+        if self.rollup:
+            self.cursor.execute(CREATE_ROLLUP_DAYS_SQL)
+        self.conn.commit()
+
+    def add(self, img_id, weather_label, weather_conf, snow_label, snow_conf, inference_ms, predicted_at):
+        self.buffer.append((img_id, weather_label, weather_conf, snow_label, snow_conf,
+                            self.model_version, predicted_at, inference_ms))
+        if len(self.buffer) >= self.flush_size:
+            self.flush()
+
+    def add_derivatives(self, img_id, thumbnail_path, preview_path):
+        self.derivative_buffer.append((img_id, thumbnail_path, preview_path))
+        if len(self.derivative_buffer) >= self.flush_size:
+            self.flush()
+
+    def mark_done(self, img_id):
+        # Every row up to img_id has either been buffered or has failed.
+        self.last_done_id = img_id
+
+    def flush(self):
+        if not self.buffer and not self.derivative_buffer:
+            self._save_checkpoint()
+            return
+
+        flush_start = time.perf_counter()
+        self._stage("#PredictionStaging", self.buffer)
+
+        if self.rollup:
+            # Taken before touching Images, so shards flushing the same days
+            # queue here instead of deadlocking on each other's row locks
+            lock_rollup(self.cursor)
+        self.cursor.execute("""
+            UPDATE i
+            SET i.WeatherPrediction = s.WeatherPrediction,
+                i.WeatherPredictionPercent = s.WeatherPredictionPercent,
+                i.SnowPrediction = s.SnowPrediction,
+                i.SnowPredictionPercent = s.SnowPredictionPercent,
+                i.ModelVersion = s.ModelVersion,
+                i.PredictedAt = s.PredictedAt,
+                i.InferenceMs = s.InferenceMs
+            FROM Images i
+            JOIN #PredictionStaging s ON i.Id = s.Id;
+        """)
+        if self.rollup:
+            # Recompute the per-day rollup for the days these rows fall on, in the same transaction
+            self.cursor.execute(TOUCHED_DAYS_SQL)
+            self.cursor.execute(RECOMPUTE_DAYS_SQL)
+        self.cursor.execute("TRUNCATE TABLE #PredictionStaging;")
+        if self.derivative_buffer:
+            self._stage("#DerivativeStaging", self.derivative_buffer)
+            self.cursor.execute("""
+                UPDATE i
+                SET i.ThumbnailPath = s.ThumbnailPath,
+                    i.PreviewPath = s.PreviewPath
+                FROM Images i
+                JOIN #DerivativeStaging s ON i.Id = s.Id;
+                TRUNCATE TABLE #DerivativeStaging;
+            """)
+        self.conn.commit()
+
+        self.flush_seconds += time.perf_counter() - flush_start
+        if self.metrics:
+            self.metrics.add_time("db_flush", time.perf_counter() - flush_start, len(self.buffer))
+        self.written += len(self.buffer)
+        self.buffer = []
+        self.derivative_buffer = []
+        self._save_checkpoint()
+
+    def _stage(self, table, rows):
+        for start in range(0, len(rows), STAGING_ROWS_PER_INSERT):
+            chunk = rows[start:start + STAGING_ROWS_PER_INSERT]
+            row_values = "(" + ", ".join(["%s"] * len(chunk[0])) + ")"
+            values = ", ".join([row_values] * len(chunk))
+            params = tuple(value for row in chunk for value in row)
+            self.cursor.execute(f"INSERT INTO {table} VALUES {values}", params)
+
+    def _save_checkpoint(self):
+        if self.checkpoint_path and self.last_done_id is not None:
+            save_checkpoint(self.checkpoint_path, self.last_done_id)
+
+    def close(self):
+        self.flush()
+        self.cursor.close()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run weather/snow predictions over the Images table')
+    parser.add_argument('--model', type=str, default='best_model.pth', help='Path to the model file')
+    parser.add_argument('--base-path', type=str, default='/', help='Folder the image FilePaths are relative to')
+    parser.add_argument('--batch-size', type=int, default=32, help='Images per forward pass')
+    parser.add_argument('--num-workers', type=int, default=4,
+                        help='DataLoader worker processes used for decoding (0 decodes in the main process)')
+    parser.add_argument('--page-size', type=int, default=5000,
+                        help='Rows fetched from the database per page')
+    parser.add_argument('--backend', choices=BACKENDS, default='eager',
+                        help='Inference backend; everything except eager runs on CPU only')
+    parser.add_argument('--calibration-dir', type=str, default=None,
+                        help='Folder of sample images used to calibrate the int8-static backend')
+    parser.add_argument('--dedup', choices=['off', 'content', 'perceptual'], default='off',
+                        help='Reuse cached predictions for identical files (content) or near-identical frames (perceptual)')
+    parser.add_argument('--cache', type=str, default='prediction_cache.sqlite',
+                        help='Local prediction cache used by --dedup')
+    parser.add_argument('--timeseries', action='store_true',
+                        help='Walk each site/sub-site/camera stream in time order, skipping dark frames and '
+                             'reusing predictions for frames that barely change')
+    parser.add_argument('--dark-threshold', type=float, default=40,
+                        help='Frames with mean brightness (0-255) below this are labeled Too Dark without the model')
+    parser.add_argument('--diff-threshold', type=float, default=0.02,
+                        help='Mean absolute pixel change (0-1) below which a frame reuses the previous prediction')
+    parser.add_argument('--max-gap', type=float, default=3600,
+                        help='Seconds after which a camera frame is always re-predicted')
+    parser.add_argument('--index-root', nargs='+', default=None,
+                        help='Archive folders to index up front, so missing files are found without a stat per row')
+    parser.add_argument('--index-cache', type=str, default='file_index.json',
+                        help='File index cache, refreshed by directory mtime')
+    parser.add_argument('--missing-report', type=str, default='missing_files.csv',
+                        help='CSV listing rows whose file is not in the index')
+    parser.add_argument('--derivatives', type=str, default=None,
+                        help='Folder for thumbnail and preview JPEGs made from the decoded images; '
+                             'their paths are stored in ThumbnailPath and PreviewPath')
+    parser.add_argument('--derivative-quality', type=int, default=85, help='JPEG quality of the derivatives')
+    parser.add_argument('--embeddings', type=str, default=None,
+                        help='Folder of the embedding store receiving each predicted image\'s 512-d features')
+    parser.add_argument('--no-rollup', action='store_true',
+                        help='Do not maintain the ImagePredictionDaily per-site/camera/day rollup')
+    parser.add_argument('--flush-size', type=int, default=5000,
+                        help='Predictions buffered before each bulk write and commit')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only predict rows without predictions or predicted by a different model')
+    parser.add_argument('--checkpoint', type=str, default='initialize.checkpoint',
+                        help='File recording the last committed Id')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue after the Id recorded in the checkpoint file')
+    parser.add_argument('--shard-index', type=int, default=0, help='Which shard of the Images table this process handles')
+    parser.add_argument('--shard-count', type=int, default=1,
+                        help='Number of shards; each process takes the rows with Id %% shard-count = shard-index')
+    parser.add_argument('--threads', type=int, default=None, help='torch CPU threads for this process')
+    parser.add_argument('--log', type=str, default='initialize.log', help='Log file path')
+    parser.add_argument('--metrics', type=str, default='initialize_metrics.jsonl',
+                        help='JSON lines file receiving per-stage timings, throughput and ETA')
+    parser.add_argument('--metrics-prom', type=str, default=None,
+                        help='Also write metrics in Prometheus text format to this file')
+    parser.add_argument('--metrics-interval', type=float, default=30,
+                        help='Seconds between metrics snapshots')
+    return parser.parse_args()
 
+def main():
+    args = parse_args()
+    if args.timeseries and args.resume:
+        sys.exit("--resume needs Id order; rerun --timeseries with --incremental to pick up where it stopped.")
+
+    log_file = open(args.log, "a" if args.resume else "w")
+    sys.stdout = Tee(log_file)
+    sys.stderr = Tee(log_file)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.shard_count > 1:
+        print(f"Running shard {args.shard_index} of {args.shard_count} with {torch.get_num_threads()} torch threads.")
+
+    device = get_best_device() if args.backend == "eager" else torch.device("cpu")
+
+    # --- Load Model ---
+    calibration_images = list_images(args.calibration_dir, limit=128) if args.calibration_dir else None
+    predictor = load_predictor(args.model, "multitask", device, backend=args.backend,
+                               calibration_images=calibration_images)
+    model_version = predictor.fingerprint
+    print(f"Model {args.model} has fingerprint {model_version}, using the {args.backend} backend.")
+
+    # --- Database Connection ---
+    conn = connect_to_database()
+    cursor = conn.cursor()
+
+    # Shards of run_sharded.py start together; the lock keeps their
+    # check-then-create schema changes from colliding
+    set_index_session_options(cursor)
+    with schema_lock(conn):
         cursor.execute("""
-            UPDATE Images
-            SET WeatherPrediction = %s,
-                WeatherPredictionPercent = %s,
-                SnowPrediction = %s,
-                SnowPredictionPercent = %s
-            WHERE Id = %s
-        """, (weather_label, weather_conf, snow_label, snow_conf, img_id))
-
-        if i % 10000 == 0:
-            tqdm.write(f"[INFO] Processed {i}/{len(rows)} images...", file=sys.stdout)
-
-    except Exception as e:
-        tqdm.write(f"[ERROR] Failed on {file_path}: {e}", file=sys.stdout)
-
-conn.commit()
-cursor.close()
-conn.close()
-print("All predictions complete.")
+        IF COL_LENGTH('Images', 'WeatherPrediction') IS NULL
+            ALTER TABLE Images ADD WeatherPrediction NVARCHAR(50);
+        IF COL_LENGTH('Images', 'WeatherPredictionPercent') IS NULL
+            ALTER TABLE Images ADD WeatherPredictionPercent FLOAT;
+        IF COL_LENGTH('Images', 'SnowPrediction') IS NULL
+            ALTER TABLE Images ADD SnowPrediction NVARCHAR(50);
+        IF COL_LENGTH('Images', 'SnowPredictionPercent') IS NULL
+            ALTER TABLE Images ADD SnowPredictionPercent FLOAT;
+        IF COL_LENGTH('Images', 'ModelVersion') IS NULL
+            ALTER TABLE Images ADD ModelVersion NVARCHAR(64);
+        IF COL_LENGTH('Images', 'PredictedAt') IS NULL
+            ALTER TABLE Images ADD PredictedAt DATETIME2;
+        IF COL_LENGTH('Images', 'InferenceMs') IS NULL
+            ALTER TABLE Images ADD InferenceMs FLOAT;
+        """)
+        if args.derivatives:
+            cursor.execute("""
+            IF COL_LENGTH('Images', 'ThumbnailPath') IS NULL
+                ALTER TABLE Images ADD ThumbnailPath NVARCHAR(260);
+            IF COL_LENGTH('Images', 'PreviewPath') IS NULL
+                ALTER TABLE Images ADD PreviewPath NVARCHAR(260);
+            """)
+        conn.commit()
+
+        # Indexes for the api and prediction filters and the rollup, then the rollup itself
+        ensure_prediction_indexes(conn)
+        if not args.no_rollup:
+            ensure_rollup(conn)
+        if args.timeseries:
+            ensure_camera_time_index(conn)
+
+    # --- Prediction & DB Update ---
+    conditions = []
+    params = []
+    if args.incremental:
+        conditions.append("(WeatherPrediction IS NULL OR SnowPrediction IS NULL "
+                          "OR ModelVersion IS NULL OR ModelVersion <> %s)")
+        params.append(model_version)
+    if args.shard_count > 1:
+        conditions.append("Id %% %s = %s")
+        params += [args.shard_count, args.shard_index]
+    resume_id = load_checkpoint(args.checkpoint) if args.resume else None
+    if resume_id is not None:
+        print(f"Resuming after Id {resume_id}.")
+        total = count_rows(conn, conditions + ["Id > %s"], params + [resume_id])
+    else:
+        total = count_rows(conn, conditions, params)
+
+    if args.timeseries:
+        rows = stream_camera_rows(conn, ["Id", "FilePath", "SiteName", "SiteNumber", "CameraPositionNumber",
+                                         "UnixTime"], conditions, params, page_size=args.page_size)
+    else:
+        rows = stream_rows(conn, ["Id", "FilePath"], conditions, params,
+                           page_size=args.page_size, start_after=resume_id)
+
+    metrics = RunMetrics(total, jsonl_path=args.metrics, prom_path=args.metrics_prom,
+                         interval=args.metrics_interval,
+                         labels={"shard": f"{args.shard_index}/{args.shard_count}"})
+
+    file_index = FileIndex(args.index_root, args.index_cache).refresh() if args.index_root else None
+    missing = []
+
+    cache = PredictionCache(args.cache, model_version) if args.dedup != "off" else None
+    if args.embeddings and args.shard_count > 1:
+        # The store is grown by a single writer; shards would race on its files
+        sys.exit("--embeddings cannot be used with --shard-count > 1; run the embedding pass unsharded.")
+    embeddings = EmbeddingStore(args.embeddings, model_version) if args.embeddings else None
+    if embeddings is not None and not predictor.supports_embeddings:
+        sys.exit(f"--embeddings does not work with the {args.backend} backend; use eager or int8-dynamic.")
+    derivatives = DerivativeStore(args.derivatives, quality=args.derivative_quality) if args.derivatives else None
+    dataset = ImageRowDataset(args.base_path, predictor.transform, predictor.draft_size,
+                              dedup=args.dedup, cache_path=args.cache, model_version=model_version,
+                              timeseries=args.timeseries, dark_threshold=args.dark_threshold,
+                              file_index=file_index, derivatives=derivatives)
+    loader = DataLoader(dataset, batch_size=args.batch_size,
+                        sampler=StreamingRowSampler(rows, metrics),
+                        num_workers=args.num_workers, collate_fn=collate_rows,
+                        pin_memory=device.type == "cuda")
+
+    writer = PredictionWriter(conn, model_version, flush_size=args.flush_size,
+                              checkpoint_path=args.checkpoint, metrics=metrics, rollup=not args.no_rollup)
+
+    print(f"Starting image prediction run (batch size {args.batch_size}, {args.num_workers} workers).")
+
+    start_time = time.perf_counter()
+    progress = tqdm(total=total, desc="Predicting images", file=sys.stdout)
+
+    gate = StreamGate(args.diff_threshold, args.max_gap) if args.timeseries else None
+    cache_hits = 0
+    dark_skipped = 0
+    gated = 0
+    batches = iter(loader)
+    while True:
+        wait_start = time.perf_counter()
+        try:
+            batch = next(batches)
+        except StopIteration:
+            break
+        ids, images, cached, failed = batch["ids"], batch["images"], batch["cached"], batch["failed"]
+        handled = len(ids) + len(cached) + len(batch["dark"]) + len(failed)
+        # Time spent waiting on the loader means decoding or the database can't keep up
+        metrics.add_time("loader_wait", time.perf_counter() - wait_start, handled)
+        metrics.add_time("decode", batch["decode_s"], handled)
+        metrics.set_gauge("queue_depth", getattr(batches, "_tasks_outstanding", 0))
+
+        if cached:
+            predicted_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            for img_id, result in cached:
+                writer.add(img_id, *result, 0.0, predicted_at)
+            metrics.done(len(cached))
+            cache_hits += len(cached)
+            metrics.set_gauge("cache_hits", cache_hits)
+
+        if batch["dark"]:
+            predicted_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            for img_id in batch["dark"]:
+                writer.add(img_id, DARK_LABEL, None, DARK_LABEL, None, 0.0, predicted_at)
+            metrics.done(len(batch["dark"]))
+            dark_skipped += len(batch["dark"])
+            metrics.set_gauge("dark_skipped", dark_skipped)
+
+        # Frames close to their camera's last predicted frame copy its result
+        run = list(range(len(ids)))
+        refs = [None] * len(ids)
+        copies = []
+        if gate and ids:
+            run = []
+            for i, (stream, unix_time, signature) in enumerate(zip(batch["streams"], batch["times"],
+                                                                  batch["signatures"])):
+                ref = gate.reference(stream, unix_time, signature)
+                if ref is not None:
+                    copies.append((ids[i], ref))
+                else:
+                    refs[i] = gate.set_reference(stream, unix_time, signature)
+                    run.append(i)
+            images = images[run] if run else None
+
+        for img_id, file_path, (kind, message) in failed:
+            metrics.error(kind)
+            # Reported together at the end instead of one line per row
+            if file_index and kind == "FileNotFoundError":
+                missing.append((img_id, file_path))
+                continue
+            tqdm.write(f"[ERROR] Failed on {file_path}: {message}", file=sys.stdout)
+
+        for img_id, paths in batch["derivatives"]:
+            writer.add_derivatives(img_id, paths["thumb"], paths["preview"])
+
+        if images is not None:
+            try:
+                results = predict_batch(predictor, images, metrics, embeddings, [ids[i] for i in run])
+                predicted_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+                for i, result in zip(run, results):
+                    writer.add(ids[i], *result, predicted_at)
+                    if refs[i] is not None:
+                        refs[i]["result"] = result[:4]
+                if cache:
+                    cache.put_many((batch["keys"][i], result[:4]) for i, result in zip(run, results))
+                metrics.done(len(run))
+            except Exception as e:
+                tqdm.write(f"[ERROR] Failed on batch starting at Id {ids[run[0]]}: {e}", file=sys.stdout)
+                for i in run:
+                    metrics.error(type(e).__name__)
+                    if refs[i] is not None:
+                        refs[i]["failed"] = True
+
+        if copies:
+            predicted_at = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+            for img_id, ref in copies:
+                if ref["result"] is None:
+                    metrics.error("ReferenceFailed")
+                    continue
+                writer.add(img_id, *ref["result"], 0.0, predicted_at)
+                metrics.done(1)
+            gated += len(copies)
+            metrics.set_gauge("gated", gated)
+
+        batch_ids = ids + [img_id for img_id, _ in cached] + batch["dark"] + [img_id for img_id, _, _ in failed]
+        # The Id checkpoint only holds in Id order
+        if batch_ids and not args.timeseries:
+            writer.mark_done(max(batch_ids))
+        metrics.set_gauge("write_buffer", len(writer.buffer))
+
+        done = progress.n + handled
+        if done // 10000 > progress.n // 10000:
+            tqdm.write(f"[INFO] Processed {done}/{total} images...", file=sys.stdout)
+        progress.update(handled)
+        metrics.maybe_emit()
+
+    progress.close()
+    elapsed = time.perf_counter() - start_time
+
+    writer.close()
+    if cache:
+        cache.close()
+    if embeddings is not None:
+        embeddings.close()
+    cursor.close()
+    conn.close()
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    summary = metrics.close()
+    print(f"Predicted {metrics.processed} images ({metrics.failed} failed) in {elapsed:.1f}s "
+          f"= {metrics.processed / elapsed if elapsed > 0 else 0:.1f} images/sec.")
+    if cache:
+        print(f"Resolved {cache_hits} images from the prediction cache without a forward pass.")
+    if file_index:
+        write_csv(args.missing_report, ["Id", "FilePath"], missing)
+        print(f"{len(missing)} rows point to files missing from the archive index, listed in {args.missing_report}.")
+    if gate:
+        print(f"Skipped {dark_skipped} dark frames and reused predictions for {gated} unchanged frames.")
+    print(f"Wrote {writer.written} predictions in {writer.flush_seconds:.1f}s of database time.")
+    print("Average ms per image by stage: " + ", ".join(f"{stage} {ms}" for stage, ms in summary["stage_ms"].items()))
+    if summary["errors"]:
+        print("Errors by type: " + ", ".join(f"{kind} {count}" for kind, count in summary["errors"].items()))
+    print("All predictions complete.")
+
+if __name__ == "__main__":
+    main()
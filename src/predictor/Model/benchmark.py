@@ -0,0 +1,259 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import tempfile
+import time
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+from predictor_core import (MODEL_REGISTRY, BACKENDS, load_predictor, list_images, open_image,
+                            preprocess_image)
+
+# Benchmark harness for the predictor hot paths. Runs offline against a folder
+# of sample images (or generated ones) and an in-memory SQLite stand-in for the
+# Images table, timing each stage separately:
+#   decode    - opening and decoding the JPEG, with and without draft mode
+#   transform - resize/crop to a uint8 tensor
+#   forward   - normalization plus the model, per backend, batch size and thread count
+#   pipeline  - the DataLoader pipeline end to end, per worker count and batch size
+#   db        - keyset-paged reads and staged bulk writes
+# Results are written as JSON so runs can be compared across machines and commits.
+
+def make_synthetic_images(folder, count, size):
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        # Smooth gradients plus noise compress more like camera frames than pure noise
+        gradient = np.linspace(0, 255, size[0], dtype=np.float32)[None, :, None]
+        pixels = gradient + rng.normal(0, 20, (size[1], size[0], 3))
+        path = os.path.join(folder, f"synthetic_{i:05d}.jpg")
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+def per_image_ms(elapsed, count):
+    return elapsed * 1000 / count if count else 0.0
+
+def bench_decode(paths, draft_size):
+    results = {}
+    for name, size in (("full", None), ("draft", draft_size)):
+        start = time.perf_counter()
+        for path in paths:
+            open_image(path, size).load()
+        results[name] = {"ms_per_image": per_image_ms(time.perf_counter() - start, len(paths))}
+    return results
+
+def bench_transform(paths, transform, draft_size):
+    images = [open_image(path, draft_size) for path in paths]
+    start = time.perf_counter()
+    for image in images:
+        transform(image)
+    return {"ms_per_image": per_image_ms(time.perf_counter() - start, len(images))}
+
+def bench_forward(model_path, arch, backends, batch_sizes, threads_list, calibration, repeats):
+    results = []
+    default_threads = torch.get_num_threads()
+    for backend in backends:
+        try:
+            predictor = load_predictor(model_path, arch, backend=backend, calibration_images=calibration)
+        except Exception as e:
+            results.append({"backend": backend, "error": str(e)})
+            continue
+        for threads in threads_list:
+            torch.set_num_threads(threads)
+            for batch_size in batch_sizes:
+                batch = torch.randint(0, 256, (batch_size, 3, 224, 224), dtype=torch.uint8)
+                predictor.predict_batch(batch)  # warm up
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    predictor.predict_batch(batch)
+                elapsed = time.perf_counter() - start
+                results.append({
+                    "backend": backend,
+                    "threads": threads,
+                    "batch_size": batch_size,
+                    "ms_per_image": per_image_ms(elapsed, batch_size * repeats),
+                    "images_per_sec": batch_size * repeats / elapsed
+                })
+    torch.set_num_threads(default_threads)
+    return results
+
+class BenchDataset(Dataset):
+    def __init__(self, paths, transform, draft_size):
+        self.paths = paths
+        self.transform = transform
+        self.draft_size = draft_size
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        return preprocess_image(self.paths[idx], self.transform, self.draft_size)
+
+def bench_pipeline(model_path, arch, paths, batch_sizes, workers_list):
+    predictor = load_predictor(model_path, arch)
+    dataset = BenchDataset(paths, predictor.transform, predictor.draft_size)
+    results = []
+    for workers in workers_list:
+        for batch_size in batch_sizes:
+            loader = DataLoader(dataset, batch_size=batch_size, num_workers=workers)
+            start = time.perf_counter()
+            for batch in loader:
+                predictor.predict_batch(batch)
+            elapsed = time.perf_counter() - start
+            results.append({
+                "workers": workers,
+                "batch_size": batch_size,
+                "ms_per_image": per_image_ms(elapsed, len(paths)),
+                "images_per_sec": len(paths) / elapsed
+            })
+    return results
+
+def bench_db(rows, page_size, flush_size):
+    # SQLite stand-in with the same access pattern as ML_initialize.py:
+    # keyset pages on Id, then staged multi-row inserts applied with UPDATE ... FROM
+    conn = sqlite3.connect(":memory:")
+    cursor = conn.cursor()
+    cursor.execute("""CREATE TABLE Images (Id INTEGER PRIMARY KEY, FilePath TEXT,
+                      WeatherPrediction TEXT, WeatherPredictionPercent REAL,
+                      SnowPrediction TEXT, SnowPredictionPercent REAL)""")
+    cursor.executemany("INSERT INTO Images (Id, FilePath) VALUES (?, ?)",
+                       ((i, f"/app/images/site/{i}.jpg") for i in range(1, rows + 1)))
+    cursor.execute("""CREATE TEMP TABLE PredictionStaging (Id INTEGER PRIMARY KEY,
+                      WeatherPrediction TEXT, WeatherPredictionPercent REAL,
+                      SnowPrediction TEXT, SnowPredictionPercent REAL)""")
+    conn.commit()
+
+    ids = []
+    last_id = 0
+    start = time.perf_counter()
+    while True:
+        cursor.execute("SELECT Id, FilePath FROM Images WHERE Id > ? ORDER BY Id LIMIT ?", (last_id, page_size))
+        page = cursor.fetchall()
+        if not page:
+            break
+        ids.extend(row[0] for row in page)
+        last_id = page[-1][0]
+    read_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for offset in range(0, len(ids), flush_size):
+        chunk = [(img_id, "Sunny", 90.0, "Snow", 80.0) for img_id in ids[offset:offset + flush_size]]
+        cursor.executemany("INSERT INTO PredictionStaging VALUES (?, ?, ?, ?, ?)", chunk)
+        cursor.execute("""
+            UPDATE Images
+            SET WeatherPrediction = s.WeatherPrediction,
+                WeatherPredictionPercent = s.WeatherPredictionPercent,
+                SnowPrediction = s.SnowPrediction,
+                SnowPredictionPercent = s.SnowPredictionPercent
+            FROM PredictionStaging s
+            WHERE Images.Id = s.Id
+        """)
+        cursor.execute("DELETE FROM PredictionStaging")
+        conn.commit()
+    write_elapsed = time.perf_counter() - start
+    conn.close()
+
+    return {
+        "backend": "sqlite",
+        "rows": rows,
+        "read_ms_per_row": per_image_ms(read_elapsed, rows),
+        "write_ms_per_row": per_image_ms(write_elapsed, rows)
+    }
+
+def bench_mssql(page_size, limit):
+    # Read-only against the real database; nothing is written
+    from db_connect import connect_to_database, stream_rows
+    conn = connect_to_database()
+    count = 0
+    start = time.perf_counter()
+    for _ in stream_rows(conn, ["Id", "FilePath"], page_size=page_size):
+        count += 1
+        if count >= limit:
+            break
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return {"backend": "mssql", "rows": count, "read_ms_per_row": per_image_ms(elapsed, count)}
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(",")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark decode, transform, forward and database stages')
+    parser.add_argument('--model', type=str, default=None,
+                        help='Path to the model file (default: randomly initialized weights)')
+    parser.add_argument('--arch', choices=sorted(MODEL_REGISTRY), default='multitask', help='Model architecture')
+    parser.add_argument('--images', type=str, default=None, help='Folder of sample images')
+    parser.add_argument('--synthetic', type=int, default=64,
+                        help='Number of images to generate when --images is not given')
+    parser.add_argument('--synthetic-size', type=str, default='1296x960', help='Generated image size, WxH')
+    parser.add_argument('--limit', type=int, default=256, help='Maximum number of sample images to use')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=['eager'], help='Backends to time')
+    parser.add_argument('--batch-sizes', type=parse_int_list, default=[1, 8, 32], help='Comma separated batch sizes')
+    parser.add_argument('--workers', type=parse_int_list, default=[0, 2, 4], help='Comma separated worker counts')
+    parser.add_argument('--threads', type=parse_int_list, default=[torch.get_num_threads()],
+                        help='Comma separated torch thread counts')
+    parser.add_argument('--repeats', type=int, default=5, help='Forward passes timed per setting')
+    parser.add_argument('--db-rows', type=int, default=100000, help='Rows in the SQLite stand-in')
+    parser.add_argument('--page-size', type=int, default=5000, help='Rows per keyset page')
+    parser.add_argument('--flush-size', type=int, default=5000, help='Rows per staged write')
+    parser.add_argument('--mssql', action='store_true', help='Also time reads from the database in db_connect.py')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='JSON results file')
+
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.images:
+            paths = list_images(args.images, limit=args.limit)
+        else:
+            width, height = (int(v) for v in args.synthetic_size.split("x"))
+            paths = make_synthetic_images(tmp, min(args.synthetic, args.limit), (width, height))
+        if not paths:
+            print("Error: No sample images found")
+            exit(1)
+
+        model_path = args.model
+        if model_path is None:
+            model_path = os.path.join(tmp, "random_model.pth")
+            torch.save(MODEL_REGISTRY[args.arch]["build"]().state_dict(), model_path)
+
+        spec = MODEL_REGISTRY[args.arch]
+        print(f"Benchmarking {len(paths)} images")
+
+        results = {
+            "machine": {
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "torch": torch.__version__,
+                "torch_threads": torch.get_num_threads()
+            },
+            "config": {key: value for key, value in vars(args).items() if key != "output"},
+            "images": len(paths)
+        }
+
+        results["decode"] = bench_decode(paths, spec["draft_size"])
+        print(f"Decode: {json.dumps(results['decode'])}")
+        results["transform"] = bench_transform(paths, spec["transform"], spec["draft_size"])
+        print(f"Transform: {json.dumps(results['transform'])}")
+
+        results["forward"] = bench_forward(model_path, args.arch, args.backends, args.batch_sizes,
+                                           args.threads, paths[:64], args.repeats)
+        for row in results["forward"]:
+            print(f"Forward: {json.dumps(row)}")
+
+        results["pipeline"] = bench_pipeline(model_path, args.arch, paths, args.batch_sizes, args.workers)
+        for row in results["pipeline"]:
+            print(f"Pipeline: {json.dumps(row)}")
+
+        results["db"] = [bench_db(args.db_rows, args.page_size, args.flush_size)]
+        if args.mssql:
+            results["db"].append(bench_mssql(args.page_size, args.db_rows))
+        for row in results["db"]:
+            print(f"DB: {json.dumps(row)}")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
@@ -0,0 +1,92 @@
+import argparse
+import json
+import time
+import torch
+from data_labeling_model import CustomDataset
+from predictor_core import load_predictor, BACKENDS, WEATHER_LABELS, SNOW_LABELS
+
+# Compares every inference backend against the fp32 eager model on a labeled
+# folder (one subfolder per category, as used for training) and reports
+# accuracy, agreement with fp32, probability drift and throughput.
+
+def run_backend(predictor, batches):
+    predictions = []
+    start = time.perf_counter()
+    for batch in batches:
+        predictions.extend(predictor.predict_batch(batch))
+    return predictions, time.perf_counter() - start
+
+def score(predictions, weather_labels, snow_labels):
+    weather_correct = sum(WEATHER_LABELS[w] == p["weather"] for p, w in zip(predictions, weather_labels))
+    snow_correct = sum(SNOW_LABELS[s] == p["snow"] for p, s in zip(predictions, snow_labels))
+    return weather_correct / len(predictions) * 100, snow_correct / len(predictions) * 100
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check accuracy and speed of the inference backends')
+    parser.add_argument('--model', type=str, default='best_model.pth', help='Path to the model file')
+    parser.add_argument('--data', type=str, required=True, help='Labeled folder with one subfolder per category')
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS, help='Backends to check')
+    parser.add_argument('--limit', type=int, default=1000, help='Maximum number of labeled images to use')
+    parser.add_argument('--batch-size', type=int, default=32, help='Images per forward pass')
+    parser.add_argument('--tolerance', type=float, default=1.0,
+                        help='Allowed accuracy drop versus fp32, in percentage points')
+    parser.add_argument('--output', type=str, default=None, help='Also write the report to this JSON file')
+
+    args = parser.parse_args()
+
+    dataset = CustomDataset(args.data)
+    paths = dataset.image_paths[:args.limit]
+    weather_labels = dataset.weather_labels[:args.limit]
+    snow_labels = dataset.snow_labels[:args.limit]
+    if not paths:
+        print(f"Error: No labeled images found in {args.data}")
+        exit(1)
+
+    reference = load_predictor(args.model, "multitask")
+    images = [reference.preprocess(path) for path in paths]
+    batches = [torch.stack(images[i:i + args.batch_size]) for i in range(0, len(images), args.batch_size)]
+    print(f"Checking {len(paths)} labeled images from {args.data}")
+
+    baseline, _ = run_backend(reference, batches)
+    baseline_weather, baseline_snow = score(baseline, weather_labels, snow_labels)
+
+    report = []
+    failed = False
+    for backend in args.backends:
+        try:
+            predictor = load_predictor(args.model, "multitask", backend=backend, calibration_images=paths[:128])
+            predictions, elapsed = run_backend(predictor, batches)
+        except Exception as e:
+            print(f"{backend:>13}: Error: {e}")
+            report.append({"backend": backend, "error": str(e)})
+            failed = True
+            continue
+
+        weather_acc, snow_acc = score(predictions, weather_labels, snow_labels)
+        agreement = sum(p["weather"] == b["weather"] and p["snow"] == b["snow"]
+                        for p, b in zip(predictions, baseline)) / len(paths) * 100
+        max_drift = max(max(abs(p["weather_prob"] - b["weather_prob"]), abs(p["snow_prob"] - b["snow_prob"]))
+                        for p, b in zip(predictions, baseline))
+        passed = (baseline_weather - weather_acc <= args.tolerance
+                  and baseline_snow - snow_acc <= args.tolerance)
+        failed = failed or not passed
+
+        report.append({
+            "backend": backend,
+            "weather_acc": weather_acc,
+            "snow_acc": snow_acc,
+            "agreement": agreement,
+            "max_prob_drift": max_drift,
+            "images_per_sec": len(paths) / elapsed,
+            "passed": passed
+        })
+        print(f"{backend:>13}: Weather Acc = {weather_acc:.2f}%, Snow Acc = {snow_acc:.2f}%, "
+              f"Agreement = {agreement:.2f}%, Max Prob Drift = {max_drift:.4f}, "
+              f"{len(paths) / elapsed:.1f} images/sec {'PASS' if passed else 'FAIL'}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"baseline": {"weather_acc": baseline_weather, "snow_acc": baseline_snow},
+                       "tolerance": args.tolerance, "backends": report}, f, indent=2)
+
+    exit(1 if failed else 0)
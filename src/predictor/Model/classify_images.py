@@ -1,56 +1,34 @@
 import torch
-from torchvision import models, transforms
-from PIL import Image
+from torch.utils.data import Dataset, DataLoader, Sampler
+from predictor_core import load_predictor, list_images, preprocess_image
 import argparse
+import glob
+import json
 import os
+import sys
+import time
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
-# Load model only once when script starts
+# The model is loaded once per file and cached by predictor_core
 device = torch.device("cpu")
-model = None
 
 def load_model(model_path):
-    global model
-    if model is None:
-        model = models.resnet34(pretrained=False)
-        model.fc = torch.nn.Sequential(
-            torch.nn.Linear(model.fc.in_features, 2)
-        )
-        model.load_state_dict(torch.load(model_path, map_location=device))
-        model.to(device)
-        model.eval()
-    return model
-
-# Prepare transforms only once
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-])
+    return load_predictor(model_path, "snow_binary", device)
 
 def classify_image(image_path, model_path="best_model.pth"):
     try:
         # Load model if not already loaded
-        model = load_model(model_path)
+        predictor = load_model(model_path)
 
-        # Load and preprocess the image
-        image = Image.open(image_path).convert("RGB")
-        image_tensor = transform(image).unsqueeze(0).to(device)
-
-        # Get prediction
-        with torch.no_grad():
-            output = torch.sigmoid(model(image_tensor))
-            has_snow_prob = output[0][0].item()
-            no_snow_prob = output[0][1].item()
-            
-            prediction = 'Has Snow' if has_snow_prob > no_snow_prob else 'No Snow'
+        # Load, preprocess and predict
+        result = predictor.predict_batch([image_path])[0]
 
         # Print results in a parseable format
-        print(f"Prediction:{prediction}")
-        print(f"Snow Probability:{has_snow_prob:.2%}")
-        print(f"No Snow Probability:{no_snow_prob:.2%}")
+        print(f"Prediction:{result['prediction']}")
+        print(f"Snow Probability:{result['snow_prob']:.2%}")
+        print(f"No Snow Probability:{result['no_snow_prob']:.2%}")
 
         return True
 
@@ -58,6 +36,79 @@ def classify_image(image_path, model_path="best_model.pth"):
         print(f"Error: {str(e)}")
         return False
 
+# --- Batch Mode ---
+# Directories, globs and paths read from stdin are classified in batches with a
+# single model load, and each result is printed as one JSON line. Paths are
+# handed to the DataLoader through the sampler as they are found, so stdin is
+# consumed as a stream and decoding runs in --workers processes.
+def expand_inputs(inputs):
+    for item in inputs:
+        if item == "-":
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+        elif os.path.isdir(item):
+            yield from list_images(item)
+        elif glob.has_magic(item):
+            yield from sorted(glob.glob(item, recursive=True))
+        else:
+            yield item
+
+class PathSampler(Sampler):
+    def __init__(self, paths):
+        self.paths = paths
+
+    def __iter__(self):
+        return iter(self.paths)
+
+class ImagePathDataset(Dataset):
+    def __init__(self, predictor):
+        # Only the transform goes to the workers, not the model
+        self.transform = predictor.transform
+        self.draft_size = predictor.draft_size
+
+    def __getitem__(self, path):
+        try:
+            return {"path": path, "image": preprocess_image(path, self.transform, self.draft_size), "error": None}
+        except Exception as e:
+            return {"path": path, "image": None, "error": str(e)}
+
+def collate_paths(batch):
+    ok = [item for item in batch if item["image"] is not None]
+    return {
+        "paths": [item["path"] for item in ok],
+        "images": torch.stack([item["image"] for item in ok]) if ok else None,
+        "failed": [(item["path"], item["error"]) for item in batch if item["error"] is not None]
+    }
+
+def classify_many(inputs, model_path="best_model.pth", batch_size=32, workers=0, out=sys.stdout):
+    predictor = load_model(model_path)
+    loader = DataLoader(ImagePathDataset(predictor), batch_size=batch_size,
+                        sampler=PathSampler(expand_inputs(inputs)),
+                        num_workers=workers, collate_fn=collate_paths)
+    classified = 0
+    failed = 0
+    for batch in loader:
+        for path, error in batch["failed"]:
+            out.write(json.dumps({"path": path, "error": error}) + "\n")
+        failed += len(batch["failed"])
+        if batch["images"] is not None:
+            start = time.perf_counter()
+            results = predictor.predict_batch(batch["images"])
+            # Latency is the per-image share of the batch forward pass
+            latency_ms = (time.perf_counter() - start) * 1000 / len(results)
+            for path, result in zip(batch["paths"], results):
+                out.write(json.dumps({
+                    "path": path,
+                    "label": result["prediction"],
+                    "snow_prob": result["snow_prob"],
+                    "no_snow_prob": result["no_snow_prob"],
+                    "latency_ms": round(latency_ms, 3)
+                }) + "\n")
+            classified += len(results)
+        out.flush()
+    return classified, failed
+
 def send_email(email_address, results):
     # Configure this with your email settings
     sender_email = "your-email@example.com"
@@ -86,13 +137,30 @@ def send_email(email_address, results):
         print(f"Error sending email: {str(e)}")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description='Classify an image for snow conditions')
-    parser.add_argument('image_path', type=str, help='Path to the image file')
+    parser = argparse.ArgumentParser(description='Classify images for snow conditions')
+    parser.add_argument('inputs', nargs='*', default=['-'],
+                        help='Image files, folders or glob patterns; "-" or nothing reads paths from stdin')
     parser.add_argument('--model', type=str, default='best_model.pth', help='Path to the model file')
     parser.add_argument('--email', type=str, help='Email address for results')
-    
+    parser.add_argument('--batch-size', type=int, default=32, help='Images per forward pass')
+    parser.add_argument('--workers', type=int, default=0, help='Worker processes used to decode images')
+    parser.add_argument('--jsonl', action='store_true',
+                        help='Print JSON lines even for a single image file')
+
     args = parser.parse_args()
-    
+
+    # A single image path keeps the original three-line output
+    single = (len(args.inputs) == 1 and args.inputs[0] != "-" and not os.path.isdir(args.inputs[0])
+              and not glob.has_magic(args.inputs[0]) and not args.jsonl)
+    if not single:
+        if not os.path.exists(args.model):
+            print(f"Error: Model file not found at {args.model}")
+            exit(1)
+        classified, failed = classify_many(args.inputs, args.model, args.batch_size, args.workers)
+        print(f"Classified {classified} images, {failed} failed.", file=sys.stderr)
+        exit(0 if failed == 0 else 1)
+
+    args.image_path = args.inputs[0]
     if not os.path.exists(args.image_path):
         print(f"Error: Image file not found at {args.image_path}")
         exit(1)
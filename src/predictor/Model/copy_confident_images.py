@@ -1,7 +1,10 @@
 import os
+import csv
 import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from db_connect import connect_to_database
+from file_index import FileIndex, write_csv
 
 # Define output folders and limits
 output_base = "/home/nmichelotti/Desktop/data"
@@ -21,12 +24,50 @@ thresholds = {
     "Cloudy_No_Snow": (0,0)
 }
 
+# Set to an integer to pick a reproducible random sample per category
+# instead of the lowest Ids
+random_seed = None
+
+# How files are placed in the training set:
+#   "auto"     - hardlink, falling back to a copy across filesystems
+#   "hardlink" - hardlink only
+#   "symlink"  - symlink to the original file
+#   "copy"     - always copy
+link_mode = "auto"
+copy_workers = 8
+
+# Manifest of every file placed, written next to the category folders
+manifest_path = os.path.join(output_base, "manifest.csv")
+
+# Cached index of the archive, so candidates are checked in memory rather than
+# with a stat each; rows whose file is missing are listed in missing_path
+index_cache = os.path.join(output_base, "file_index.json")
+missing_path = os.path.join(output_base, "missing_files.csv")
+
+def materialize(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    if link_mode in ("auto", "hardlink"):
+        try:
+            os.link(src, dst)
+            return "hardlink"
+        except OSError:
+            if link_mode == "hardlink":
+                raise
+    if link_mode == "symlink":
+        os.symlink(os.path.abspath(src), dst)
+        return "symlink"
+    shutil.copy2(src, dst)
+    return "copy"
+
 # Ensure folders exist
 for folder in categories:
     os.makedirs(os.path.join(output_base, folder), exist_ok=True)
 
-# Track how many we've copied
+# Track how many we've placed and how
 image_counts = {key: 0 for key in categories}
+method_counts = {}
+manifest = []
 
 # Connect to DB
 conn = connect_to_database()
@@ -34,39 +75,95 @@ cursor = conn.cursor()
 
 # Base image folder
 base_path = "/home/nmichelotti/Desktop/Image Archives/OneDrive_1_4-3-2025"
+file_index = FileIndex(base_path, index_cache).refresh()
+missing = set()
+
+# Select each category in SQL so only the rows we need leave the database
+if random_seed is None:
+    order_by = "Id"
+    order_params = ()
+else:
+    order_by = "HASHBYTES('MD5', CONCAT(Id, ':', %s)), Id"
+    order_params = (random_seed,)
 
-# Query all rows and filter in Python
-cursor.execute("""
-    SELECT FilePath, WeatherPrediction, SnowPrediction,
-           WeatherPredictionPercent, SnowPredictionPercent
+query = f"""
+    SELECT FilePath, WeatherPredictionPercent, SnowPredictionPercent
     FROM Images
-""")
-rows = cursor.fetchall()
-
-# Process rows
-for file_path, weather, snow, weather_pct, snow_pct in tqdm(rows, desc="Filtering and copying"):
-    for folder_name, (expected_weather, expected_snow) in categories.items():
-        w_thresh, s_thresh = thresholds[folder_name]
-        if weather == expected_weather and snow == expected_snow:
-            if weather_pct >= w_thresh and snow_pct >= s_thresh:
-                if image_counts[folder_name] < max_per_category:
-                    src = os.path.join(base_path, file_path.replace("/app", "").lstrip("/"))
-                    dst_folder = os.path.join(output_base, folder_name)
-                    dst = os.path.join(dst_folder, os.path.basename(src))
-                    try:
-                        if os.path.exists(src):
-                            shutil.copy2(src, dst)
-                            print(f"COPIED: {src} -> {dst}")
-                            image_counts[folder_name] += 1
-                    except Exception as e:
-                        print(f"Failed to copy {src}: {e}")
+    WHERE WeatherPrediction = %s AND SnowPrediction = %s
+      AND WeatherPredictionPercent >= %s AND SnowPredictionPercent >= %s
+    ORDER BY {order_by}
+    OFFSET %s ROWS FETCH NEXT %s ROWS ONLY
+"""
+
+executor = ThreadPoolExecutor(max_workers=copy_workers)
+
+for folder_name, (expected_weather, expected_snow) in categories.items():
+    w_thresh, s_thresh = thresholds[folder_name]
+    dst_folder = os.path.join(output_base, folder_name)
+    offset = 0
+    progress = tqdm(total=max_per_category, desc=f"Placing {folder_name}")
+
+    # Missing or failed files are skipped, so keep paging until the category is full
+    while image_counts[folder_name] < max_per_category:
+        needed = max_per_category - image_counts[folder_name]
+        cursor.execute(query, (expected_weather, expected_snow, w_thresh, s_thresh)
+                       + order_params + (offset, needed))
+        rows = cursor.fetchall()
+        if not rows:
             break
+        offset += len(rows)
+
+        futures = {}
+        for file_path, weather_pct, snow_pct in rows:
+            src = os.path.join(base_path, file_path.replace("/app", "").lstrip("/"))
+            if not file_index.exists(src):
+                missing.add(src)
+                continue
+            dst = os.path.join(dst_folder, os.path.basename(src))
+            futures[executor.submit(materialize, src, dst)] = (src, dst, weather_pct, snow_pct)
+
+        for future in as_completed(futures):
+            src, dst, weather_pct, snow_pct = futures[future]
+            try:
+                method = future.result()
+            except Exception as e:
+                print(f"Failed to place {src}: {e}")
+                continue
+            image_counts[folder_name] += 1
+            method_counts[method] = method_counts.get(method, 0) + 1
+            manifest.append({
+                "path": os.path.relpath(dst, output_base),
+                "source": src,
+                "category": folder_name,
+                "weather": expected_weather,
+                "snow": expected_snow,
+                "weather_pct": weather_pct,
+                "snow_pct": snow_pct,
+                "method": method
+            })
+            progress.update(1)
+
+    progress.close()
+
+executor.shutdown()
+
+# Write manifest
+with open(manifest_path, "w", newline="") as f:
+    writer = csv.DictWriter(f, fieldnames=["path", "source", "category", "weather", "snow",
+                                           "weather_pct", "snow_pct", "method"])
+    writer.writeheader()
+    writer.writerows(sorted(manifest, key=lambda entry: entry["path"]))
+
+write_csv(missing_path, ["path"], ([path] for path in sorted(missing)))
 
 # Clean up
 cursor.close()
 conn.close()
 
 # Report
-print("\nFinished. Images copied per category:")
+print("\nFinished. Images placed per category:")
 for category, count in image_counts.items():
     print(f"{category}: {count}")
+print("Placed by: " + ", ".join(f"{method} {count}" for method, count in method_counts.items()))
+print(f"Manifest written to {manifest_path}")
+print(f"{len(missing)} candidate files were missing from the archive, listed in {missing_path}")
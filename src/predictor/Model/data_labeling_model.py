@@ -1,53 +1,27 @@
 import torch
 import torchvision.transforms as transforms
-from torchvision import datasets, models
+from torchvision import datasets
 from torch.utils.data import DataLoader, random_split
 import os
+import argparse
+import json
+import time
+import numpy as np
+from PIL import Image
 from pathlib import Path
 from tqdm import tqdm
+from predictor_core import MultiTaskResNet, model_fingerprint, open_image, export_model, load_model_file
 import warnings
 warnings.filterwarnings('ignore', category=UserWarning)
 
-# Define MultiTask Model
-class MultiTaskResNet(torch.nn.Module):
-    def __init__(self):
-        super(MultiTaskResNet, self).__init__()
-        self.base_model = models.resnet34(pretrained=True)
-
-        for param in self.base_model.parameters():
-            param.requires_grad = False
-        for param in self.base_model.layer4.parameters():
-            param.requires_grad = True
-
-        self.features = torch.nn.Sequential(*list(self.base_model.children())[:-1])
-
-        self.weather_classifier = torch.nn.Sequential(
-            torch.nn.Dropout(0.5),
-            torch.nn.Linear(512, 256),
-            torch.nn.ReLU(),
-            torch.nn.Dropout(0.3),
-            torch.nn.Linear(256, 2)
-        )
-        self.snow_classifier = torch.nn.Sequential(
-            torch.nn.Dropout(0.5),
-            torch.nn.Linear(512, 256),
-            torch.nn.ReLU(),
-            torch.nn.Dropout(0.3),
-            torch.nn.Linear(256, 2)
-        )
-
-    def forward(self, x):
-        x = self.features(x)
-        x = torch.flatten(x, 1)
-        return self.weather_classifier(x), self.snow_classifier(x)
-
 # Custom dataset excluding "Too_Dark" images
 class CustomDataset(torch.utils.data.Dataset):
-    def __init__(self, root_dir, transform=None):
+    def __init__(self, root_dir, transform=None, draft_size=None):
         self.image_paths = []
         self.weather_labels = []
         self.snow_labels = []
         self.transform = transform
+        self.draft_size = draft_size
 
         category_map = {
             "Sunny_With_Snow": (0, 1),
@@ -69,17 +43,148 @@ class CustomDataset(torch.utils.data.Dataset):
         return len(self.image_paths)
 
     def __getitem__(self, idx):
-        image = datasets.folder.default_loader(self.image_paths[idx])
+        if self.draft_size:
+            image = open_image(self.image_paths[idx], self.draft_size)
+        else:
+            image = datasets.folder.default_loader(self.image_paths[idx])
         if self.transform:
             image = self.transform(image)
         return image, self.weather_labels[idx], self.snow_labels[idx]
 
-# Set paths
-dataset_path = "/home/nmichelotti/Desktop/data"
+# Packed, preprocessed copy of the dataset. Every image is decoded and resized
+# to 256x256 once and stored in a uint8 memmap, so epochs only pay for the
+# random augmentations and DataLoader workers share the OS page cache instead
+# of each re-reading the JPEGs.
+PACKED_SIZE = 256
+
+def packed_cache_index(dataset):
+    return [[path, os.path.getmtime(path), os.path.getsize(path)] for path in dataset.image_paths]
+
+def build_packed_cache(root_dir, cache_dir, num_workers=0):
+    dataset = CustomDataset(root_dir, transform=transforms.Compose([
+        transforms.Resize((PACKED_SIZE, PACKED_SIZE)),
+        transforms.PILToTensor()
+    ]), draft_size=(PACKED_SIZE, PACKED_SIZE))
+    images_path = os.path.join(cache_dir, "images.npy")
+    labels_path = os.path.join(cache_dir, "labels.npy")
+    index_path = os.path.join(cache_dir, "index.json")
+
+    index = packed_cache_index(dataset)
+    if os.path.exists(index_path) and os.path.exists(images_path) and os.path.exists(labels_path):
+        with open(index_path) as f:
+            if json.load(f) == index:
+                print(f"Using packed cache in {cache_dir}")
+                return
+
+    os.makedirs(cache_dir, exist_ok=True)
+    images = np.lib.format.open_memmap(images_path + ".tmp", mode="w+", dtype=np.uint8,
+                                       shape=(len(dataset), PACKED_SIZE, PACKED_SIZE, 3))
+    loader = DataLoader(dataset, batch_size=64, shuffle=False, num_workers=num_workers)
+
+    offset = 0
+    for batch, _, _ in tqdm(loader, desc="Building packed cache"):
+        images[offset:offset + len(batch)] = batch.permute(0, 2, 3, 1).numpy()
+        offset += len(batch)
+    images.flush()
+    del images
+    os.replace(images_path + ".tmp", images_path)
+
+    np.save(labels_path, np.array([dataset.weather_labels, dataset.snow_labels], dtype=np.int64).T)
+    with open(index_path, "w") as f:
+        json.dump(index, f)
+    print(f"Packed {len(dataset)} images into {cache_dir}")
+
+class PackedDataset(torch.utils.data.Dataset):
+    def __init__(self, cache_dir, transform=None):
+        self.images_path = os.path.join(cache_dir, "images.npy")
+        self.labels = np.load(os.path.join(cache_dir, "labels.npy"))
+        with open(os.path.join(cache_dir, "index.json")) as f:
+            self.image_paths = [entry[0] for entry in json.load(f)]
+        self.transform = transform
+        # Opened lazily so each worker maps the file itself after fork
+        self.images = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if self.images is None:
+            self.images = np.load(self.images_path, mmap_mode="r")
+        image = Image.fromarray(np.asarray(self.images[idx]))
+        if self.transform:
+            image = self.transform(image)
+        weather_label, snow_label = self.labels[idx]
+        return image, int(weather_label), int(snow_label)
+
+# Feature cache. Everything below layer4 is frozen, so its activations only need
+# computing once. "layer3" caches the layer3 output and still trains layer4 and
+# the heads; "pooled" caches the 512-d pooled features and trains the heads only.
+# Cached features come from the deterministic center crop, not the augmentations.
+FROZEN_STAGES = {"layer3": 7, "pooled": 9}
+
+def frozen_stage(model, level):
+    return torch.nn.Sequential(*list(model.features.children())[:FROZEN_STAGES[level]])
+
+def build_feature_cache(model, source, cache_dir, level, device, num_workers=0):
+    features_path = os.path.join(cache_dir, f"features_{level}.npy")
+    labels_path = os.path.join(cache_dir, f"feature_labels_{level}.npy")
+    index_path = os.path.join(cache_dir, f"features_{level}.json")
+
+    stage = frozen_stage(model, level).eval()
+    index = {"level": level, "backbone": model_fingerprint(stage.state_dict()), "images": packed_cache_index(source)}
+
+    if not (os.path.exists(index_path) and os.path.exists(features_path) and os.path.exists(labels_path)):
+        stale = True
+    else:
+        with open(index_path) as f:
+            stale = json.load(f) != index
+
+    if stale:
+        os.makedirs(cache_dir, exist_ok=True)
+        loader = DataLoader(source, batch_size=64, shuffle=False, num_workers=num_workers)
+        features = None
+        labels = []
+        offset = 0
+        with torch.no_grad():
+            for images, weather_labels, snow_labels in tqdm(loader, desc=f"Caching {level} features"):
+                out = stage(images.to(device)).cpu().half().numpy()
+                if features is None:
+                    features = np.lib.format.open_memmap(features_path + ".tmp", mode="w+", dtype=np.float16,
+                                                         shape=(len(source),) + out.shape[1:])
+                features[offset:offset + len(out)] = out
+                offset += len(out)
+                labels.append(torch.stack([weather_labels, snow_labels], dim=1).numpy())
+        features.flush()
+        del features
+        os.replace(features_path + ".tmp", features_path)
+        np.save(labels_path, np.concatenate(labels).astype(np.int64))
+        with open(index_path, "w") as f:
+            json.dump(index, f)
+        print(f"Cached {level} features for {len(source)} images in {cache_dir}")
+    else:
+        print(f"Using cached {level} features in {cache_dir}")
+
+    # Small enough to keep in memory: 1 KB per image pooled, 100 KB per image at layer3
+    features = torch.from_numpy(np.load(features_path))
+    labels = torch.from_numpy(np.load(labels_path))
+    return torch.utils.data.TensorDataset(features, labels[:, 0], labels[:, 1])
+
+class CachedFeatureModel(torch.nn.Module):
+    # Runs the part of MultiTaskResNet above the cached features. The layers are
+    # shared with the wrapped model, so its state_dict is what gets saved.
+    def __init__(self, model, level):
+        super(CachedFeatureModel, self).__init__()
+        self.tail = torch.nn.Sequential(*list(model.features.children())[FROZEN_STAGES[level]:])
+        self.weather_classifier = model.weather_classifier
+        self.snow_classifier = model.snow_classifier
+
+    def forward(self, x):
+        x = self.tail(x.float())
+        x = torch.flatten(x, 1)
+        return self.weather_classifier(x), self.snow_classifier(x)
 
 # Image transforms
-transform = transforms.Compose([
-    transforms.Resize((256, 256)),
+augment = [
     transforms.RandomCrop(224),
     transforms.RandomHorizontalFlip(),
     transforms.RandomRotation(10),
@@ -87,81 +192,234 @@ transform = transforms.Compose([
     transforms.ToTensor(),
     transforms.Normalize(mean=[0.485, 0.456, 0.406],
                          std=[0.229, 0.224, 0.225])
-])
-
-# Load dataset
-dataset = CustomDataset(dataset_path, transform=transform)
-train_size = int(0.8 * len(dataset))
-val_size = len(dataset) - train_size
-train_set, val_set = random_split(dataset, [train_size, val_size])
-train_loader = DataLoader(train_set, batch_size=32, shuffle=True)
-val_loader = DataLoader(val_set, batch_size=32, shuffle=False)
-
-# Training setup
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = MultiTaskResNet().to(device)
-criterion = torch.nn.CrossEntropyLoss()
-optimizer = torch.optim.Adam(model.parameters(), lr=0.001)
-scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', patience=2)
-
-# Training loop
-best_val_loss = float('inf')
-for epoch in range(30):
-    model.train()
-    running_loss = 0
-    correct_weather = 0
-    correct_snow = 0
-    total = 0
-    for images, weather_labels, snow_labels in tqdm(train_loader, desc=f"Epoch {epoch+1} [Train]"):
-        images = images.to(device)
-        weather_labels = weather_labels.to(device)
-        snow_labels = snow_labels.to(device)
-
-        optimizer.zero_grad()
-        weather_out, snow_out = model(images)
-        loss = criterion(weather_out, weather_labels) + criterion(snow_out, snow_labels)
-        loss.backward()
-        optimizer.step()
-        running_loss += loss.item()
-
-        correct_weather += (torch.argmax(weather_out, 1) == weather_labels).sum().item()
-        correct_snow += (torch.argmax(snow_out, 1) == snow_labels).sum().item()
-        total += weather_labels.size(0)
-
-    train_loss = running_loss / len(train_loader)
-    weather_acc = correct_weather / total * 100
-    snow_acc = correct_snow / total * 100
-
-    model.eval()
-    val_loss = 0
-    val_correct_weather = 0
-    val_correct_snow = 0
-    val_total = 0
-    with torch.no_grad():
-        for images, weather_labels, snow_labels in val_loader:
-            images = images.to(device)
-            weather_labels = weather_labels.to(device)
-            snow_labels = snow_labels.to(device)
-
-            weather_out, snow_out = model(images)
-            loss = criterion(weather_out, weather_labels) + criterion(snow_out, snow_labels)
-            val_loss += loss.item()
-            val_correct_weather += (torch.argmax(weather_out, 1) == weather_labels).sum().item()
-            val_correct_snow += (torch.argmax(snow_out, 1) == snow_labels).sum().item()
-            val_total += weather_labels.size(0)
-
-    val_loss /= len(val_loader)
-    val_weather_acc = val_correct_weather / val_total * 100
-    val_snow_acc = val_correct_snow / val_total * 100
-
-    print(f"Epoch {epoch+1}: Train Loss = {train_loss:.4f}, Weather Acc = {weather_acc:.2f}%, Snow Acc = {snow_acc:.2f}%")
-    print(f"            Val Loss = {val_loss:.4f}, Weather Acc = {val_weather_acc:.2f}%, Snow Acc = {val_snow_acc:.2f}%")
-
-    scheduler.step(val_loss)
-
-    if val_loss < best_val_loss:
-        best_val_loss = val_loss
-        torch.save(model.state_dict(), "best_model.pth")
-        print("Saved new best model.")
-
-print("Training complete.")
+]
+transform = transforms.Compose([transforms.Resize((256, 256))] + augment)
+# Packed images are already 256x256
+packed_transform = transforms.Compose(augment)
+# Deterministic transforms used when caching features
+center = [
+    transforms.CenterCrop(224),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406],
+                         std=[0.229, 0.224, 0.225])
+]
+eval_transform = transforms.Compose([transforms.Resize((256, 256))] + center)
+packed_eval_transform = transforms.Compose(center)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Train the weather/snow MultiTaskResNet')
+    parser.add_argument('--data', type=str, default='/home/nmichelotti/Desktop/data',
+                        help='Folder with one subfolder per category')
+    parser.add_argument('--epochs', type=int, default=30, help='Number of epochs')
+    parser.add_argument('--batch-size', type=int, default=32, help='Training batch size')
+    parser.add_argument('--num-workers', type=int, default=0, help='DataLoader worker processes')
+    parser.add_argument('--packed-cache', action='store_true',
+                        help='Decode and resize every image once into a memory-mapped cache')
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help='Folder for the packed cache (default: <data>/.cache)')
+    parser.add_argument('--feature-cache', choices=sorted(FROZEN_STAGES), default=None,
+                        help='Cache frozen backbone activations once and train only the layers above them')
+    parser.add_argument('--init', type=str, default=None,
+                        help='Start from an existing model file instead of ImageNet weights')
+    parser.add_argument('--bf16', action='store_true',
+                        help='Run forward passes under bfloat16 autocast (CPUs with AVX512-BF16/AMX or recent GPUs)')
+    parser.add_argument('--channels-last', action='store_true',
+                        help='Keep the model and image batches in channels_last memory format')
+    parser.add_argument('--compile', action='store_true', help='Compile the model with torch.compile')
+    parser.add_argument('--prefetch-factor', type=int, default=4, help='Batches each DataLoader worker loads ahead')
+    parser.add_argument('--patience', type=int, default=5,
+                        help='Stop after this many epochs without a lower val loss (0 trains every epoch)')
+    parser.add_argument('--min-delta', type=float, default=0.0, help='Smallest val loss drop that counts as better')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the train/val split')
+    parser.add_argument('--output', type=str, default='best_model.pth', help='Exported best model')
+    parser.add_argument('--checkpoint', type=str, default='training.checkpoint.pth',
+                        help='Full training state saved after every epoch')
+    parser.add_argument('--resume', action='store_true', help='Continue a killed run from the checkpoint file')
+    return parser.parse_args()
+
+def save_checkpoint(path, state):
+    # Written to a temp file first so a kill mid-save keeps the previous checkpoint
+    torch.save(state, path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def loader_options(num_workers, device, prefetch_factor):
+    # Workers are kept alive between epochs instead of being re-forked, and
+    # pinned memory only helps when batches are copied to a GPU
+    options = {"num_workers": num_workers, "pin_memory": device.type == "cuda"}
+    if num_workers > 0:
+        options["persistent_workers"] = True
+        options["prefetch_factor"] = prefetch_factor
+    return options
+
+def main():
+    args = parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = MultiTaskResNet(pretrained=True).to(device)
+    if args.init:
+        model.load_state_dict(load_model_file(args.init, "multitask", map_location=device)[0])
+    train_model = model
+
+    # Load dataset
+    cache_dir = args.cache_dir or os.path.join(args.data, ".cache")
+    if args.packed_cache:
+        build_packed_cache(args.data, cache_dir, num_workers=args.num_workers)
+
+    if args.feature_cache:
+        if args.packed_cache:
+            source = PackedDataset(cache_dir, transform=packed_eval_transform)
+        else:
+            source = CustomDataset(args.data, transform=eval_transform)
+        dataset = build_feature_cache(model, source, cache_dir, args.feature_cache, device,
+                                      num_workers=args.num_workers)
+        train_model = CachedFeatureModel(model, args.feature_cache)
+        # Features are already in memory, so loading them needs no workers
+        args.num_workers = 0
+    elif args.packed_cache:
+        dataset = PackedDataset(cache_dir, transform=packed_transform)
+    else:
+        dataset = CustomDataset(args.data, transform=transform)
+
+    train_size = int(0.8 * len(dataset))
+    val_size = len(dataset) - train_size
+    # Seeded so a resumed run validates on the same images
+    train_set, val_set = random_split(dataset, [train_size, val_size],
+                                      generator=torch.Generator().manual_seed(args.seed))
+    options = loader_options(args.num_workers, device, args.prefetch_factor)
+    # A compiled model recompiles for a new batch shape, so with --compile the short last
+    # batch is dropped; the shuffle drops a different few images (under one batch) each epoch
+    train_loader = DataLoader(train_set, batch_size=args.batch_size, shuffle=True, drop_last=args.compile, **options)
+    val_loader = DataLoader(val_set, batch_size=args.batch_size, shuffle=False, **options)
+
+    memory_format = torch.channels_last if args.channels_last else torch.contiguous_format
+    if args.channels_last:
+        train_model = train_model.to(memory_format=memory_format)
+    # The compiled module shares its parameters with train_model, so model.state_dict() still saves them
+    run_model = torch.compile(train_model) if args.compile else train_model
+
+    def to_device(images):
+        # Pooled features are (N, 512, 1, 1); channels_last only matters for real feature maps
+        if images.dim() == 4:
+            return images.to(device, non_blocking=True, memory_format=memory_format)
+        return images.to(device, non_blocking=True)
+
+    def autocast():
+        return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16)
+
+    # Training setup
+    criterion = torch.nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam([p for p in train_model.parameters() if p.requires_grad], lr=0.001)
+    scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, mode='min', patience=2)
+
+    # Resume
+    start_epoch = 0
+    best_val_loss = float('inf')
+    stale_epochs = 0
+    if args.resume and os.path.exists(args.checkpoint):
+        checkpoint = torch.load(args.checkpoint, map_location=device)
+        model.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        scheduler.load_state_dict(checkpoint["scheduler"])
+        torch.set_rng_state(checkpoint["rng_state"])
+        start_epoch = checkpoint["epoch"]
+        best_val_loss = checkpoint["best_val_loss"]
+        stale_epochs = checkpoint["stale_epochs"]
+        print(f"Resuming after epoch {start_epoch} (best val loss {best_val_loss:.4f})")
+    elif args.resume:
+        print(f"No checkpoint at {args.checkpoint}, starting from scratch")
+
+    # Training loop
+    for epoch in range(start_epoch, args.epochs):
+        if args.patience and stale_epochs >= args.patience:
+            break
+        train_model.train()
+        # Accumulated on the device and read once per epoch, so batches never wait on a sync
+        running_loss = torch.zeros((), device=device)
+        correct_weather = torch.zeros((), dtype=torch.long, device=device)
+        correct_snow = torch.zeros((), dtype=torch.long, device=device)
+        total = 0
+        start = time.perf_counter()
+        for images, weather_labels, snow_labels in tqdm(train_loader, desc=f"Epoch {epoch+1} [Train]"):
+            images = to_device(images)
+            weather_labels = weather_labels.to(device, non_blocking=True)
+            snow_labels = snow_labels.to(device, non_blocking=True)
+
+            optimizer.zero_grad(set_to_none=True)
+            with autocast():
+                weather_out, snow_out = run_model(images)
+                loss = criterion(weather_out, weather_labels) + criterion(snow_out, snow_labels)
+            loss.backward()
+            optimizer.step()
+            running_loss += loss.detach()
+
+            correct_weather += (torch.argmax(weather_out, 1) == weather_labels).sum()
+            correct_snow += (torch.argmax(snow_out, 1) == snow_labels).sum()
+            total += weather_labels.size(0)
+
+        train_loss = running_loss.item() / len(train_loader)
+        weather_acc = correct_weather.item() / total * 100
+        snow_acc = correct_snow.item() / total * 100
+        train_rate = total / (time.perf_counter() - start)
+
+        train_model.eval()
+        val_loss = torch.zeros((), device=device)
+        val_correct_weather = torch.zeros((), dtype=torch.long, device=device)
+        val_correct_snow = torch.zeros((), dtype=torch.long, device=device)
+        val_total = 0
+        start = time.perf_counter()
+        with torch.no_grad():
+            for images, weather_labels, snow_labels in val_loader:
+                images = to_device(images)
+                weather_labels = weather_labels.to(device, non_blocking=True)
+                snow_labels = snow_labels.to(device, non_blocking=True)
+
+                # Forward pass and loss in mixed precision, as in training; the metrics are summed outside
+                with autocast():
+                    weather_out, snow_out = run_model(images)
+                    loss = criterion(weather_out, weather_labels) + criterion(snow_out, snow_labels)
+                val_loss += loss
+                val_correct_weather += (torch.argmax(weather_out, 1) == weather_labels).sum()
+                val_correct_snow += (torch.argmax(snow_out, 1) == snow_labels).sum()
+                val_total += weather_labels.size(0)
+
+        val_loss = val_loss.item() / len(val_loader)
+        val_weather_acc = val_correct_weather.item() / val_total * 100
+        val_snow_acc = val_correct_snow.item() / val_total * 100
+        val_rate = val_total / (time.perf_counter() - start)
+
+        print(f"Epoch {epoch+1}: Train Loss = {train_loss:.4f}, Weather Acc = {weather_acc:.2f}%, Snow Acc = {snow_acc:.2f}%, "
+              f"{train_rate:.1f} samples/sec")
+        print(f"            Val Loss = {val_loss:.4f}, Weather Acc = {val_weather_acc:.2f}%, Snow Acc = {val_snow_acc:.2f}%, "
+              f"{val_rate:.1f} samples/sec")
+
+        scheduler.step(val_loss)
+
+        if val_loss < best_val_loss - args.min_delta:
+            best_val_loss = val_loss
+            stale_epochs = 0
+            fingerprint = export_model(model, args.output, epoch=epoch + 1, val_loss=val_loss,
+                                       val_weather_acc=val_weather_acc, val_snow_acc=val_snow_acc,
+                                       trained_at=time.strftime("%Y-%m-%dT%H:%M:%S"))
+            print(f"Saved new best model to {args.output} ({fingerprint[:12]}).")
+        else:
+            stale_epochs += 1
+
+        save_checkpoint(args.checkpoint, {
+            "model": model.state_dict(),
+            "optimizer": optimizer.state_dict(),
+            "scheduler": scheduler.state_dict(),
+            "rng_state": torch.get_rng_state(),
+            "epoch": epoch + 1,
+            "best_val_loss": best_val_loss,
+            "stale_epochs": stale_epochs
+        })
+
+    if args.patience and stale_epochs >= args.patience:
+        print(f"Stopped early: val loss has not improved for {stale_epochs} epochs.")
+    # A finished run starts fresh next time
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    print(f"Training complete. Best val loss {best_val_loss:.4f}, model in {args.output}")
+
+if __name__ == "__main__":
+    main()
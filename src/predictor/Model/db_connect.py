@@ -1,4 +1,5 @@
 import pymssql
+from contextlib import contextmanager
 
 def connect_to_database():
     try:
@@ -14,3 +15,122 @@ def connect_to_database():
     except Exception as e:
         print(f"Database connection failed: {e}")
         return None
+
+def stream_rows(conn, columns, conditions=None, params=(), page_size=5000, start_after=None):
+    # Keyset pagination on Images.Id: each page is a bounded, index-seekable query,
+    # so memory stays flat and rows are available as soon as the first page lands.
+    # The first column must be Id.
+    cursor = conn.cursor()
+    last_id = start_after
+    try:
+        while True:
+            where = list(conditions or [])
+            page_params = list(params)
+            if last_id is not None:
+                where.append("Id > %s")
+                page_params.append(last_id)
+
+            query = f"SELECT TOP ({int(page_size)}) {', '.join(columns)} FROM Images"
+            if where:
+                query += " WHERE " + " AND ".join(where)
+            query += " ORDER BY Id"
+
+            cursor.execute(query, tuple(page_params))
+            page = cursor.fetchall()
+            if not page:
+                return
+            for row in page:
+                yield row
+            last_id = page[-1][0]
+    finally:
+        cursor.close()
+
+def count_rows(conn, conditions=None, params=()):
+    cursor = conn.cursor()
+    query = "SELECT COUNT(*) FROM Images"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    cursor.execute(query, tuple(params))
+    count = cursor.fetchone()[0]
+    cursor.close()
+    return count
+
+CAMERA_TIME_INDEX = "IX_Images_CameraUnixTime"
+
+def ensure_camera_time_index(conn):
+    # Lets each stream_camera_rows page seek instead of scanning Images.
+    # Call under schema_lock() so concurrent shards do not both create it.
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sys.indexes WHERE name = %s AND object_id = OBJECT_ID('Images')",
+                   (CAMERA_TIME_INDEX,))
+    created = cursor.fetchone() is None
+    if created:
+        print(f"Creating index {CAMERA_TIME_INDEX}...")
+        cursor.execute(f"CREATE INDEX {CAMERA_TIME_INDEX} ON Images (SiteNumber, CameraPositionNumber, UnixTime, Id) "
+                       "INCLUDE (SiteName)")
+        conn.commit()
+    cursor.close()
+    return created
+
+def stream_camera_rows(conn, columns, conditions=None, params=(), page_size=5000):
+    # Walks each camera (SiteName, SiteNumber, CameraPositionNumber) in time
+    # order: rows without UnixTime first by Id, then keyset pagination on
+    # (UnixTime, Id), which IX_Images_CameraUnixTime serves. The first columns
+    # must be Id, and the last four SiteName, SiteNumber, CameraPositionNumber,
+    # UnixTime.
+    cursor = conn.cursor()
+    try:
+        query = "SELECT DISTINCT SiteName, SiteNumber, CameraPositionNumber FROM Images"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        cursor.execute(query + " ORDER BY SiteName, SiteNumber, CameraPositionNumber", tuple(params))
+        cameras = cursor.fetchall()
+
+        for camera_key in cameras:
+            camera_conditions = list(conditions or [])
+            camera_params = list(params)
+            for column, value in zip(("SiteName", "SiteNumber", "CameraPositionNumber"), camera_key):
+                if value is None:
+                    camera_conditions.append(f"{column} IS NULL")
+                else:
+                    camera_conditions.append(f"{column} = %s")
+                    camera_params.append(value)
+
+            for timed in (False, True):
+                last_time, last_id = None, None
+                while True:
+                    where = camera_conditions + ["UnixTime IS NOT NULL" if timed else "UnixTime IS NULL"]
+                    page_params = list(camera_params)
+                    if last_id is not None and timed:
+                        where.append("(UnixTime > %s OR (UnixTime = %s AND Id > %s))")
+                        page_params += [last_time, last_time, last_id]
+                    elif last_id is not None:
+                        where.append("Id > %s")
+                        page_params.append(last_id)
+
+                    order = "UnixTime, Id" if timed else "Id"
+                    query = (f"SELECT TOP ({int(page_size)}) {', '.join(columns)} FROM Images"
+                             f" WHERE {' AND '.join(where)} ORDER BY {order}")
+                    cursor.execute(query, tuple(page_params))
+                    page = cursor.fetchall()
+                    if not page:
+                        break
+                    for row in page:
+                        yield row
+                    last_time, last_id = page[-1][-1], page[-1][0]
+    finally:
+        cursor.close()
+
+@contextmanager
+def schema_lock(conn, resource="Images.schema"):
+    # Session-level application lock, so processes starting together (e.g. the
+    # shards of run_sharded.py) run their check-then-create DDL one at a time
+    cursor = conn.cursor()
+    cursor.execute("EXEC sp_getapplock @Resource = %s, @LockMode = 'Exclusive', "
+                   "@LockOwner = 'Session', @LockTimeout = -1", (resource,))
+    try:
+        yield cursor
+    finally:
+        cursor.execute("EXEC sp_releaseapplock @Resource = %s, @LockOwner = 'Session'", (resource,))
+        conn.commit()
+        cursor.close()
@@ -0,0 +1,46 @@
+import os
+from PIL import Image
+
+# Content-addressed store of downscaled copies of archive images, written by
+# ML_initialize.py from the same decode it does for prediction, so the gallery
+# can serve small JPEGs instead of the multi-megabyte originals.
+#
+# Files live at <root>/<name>/<hash[:2]>/<hash>.jpg, keyed by the SHA-256 of
+# the original file, so identical images share one derivative and existing
+# ones are never re-encoded. Paths recorded in the database are relative to root.
+
+DERIVATIVE_SIZES = {"thumb": 256, "preview": 1024}
+
+class DerivativeStore:
+    def __init__(self, root, sizes=None, quality=85):
+        self.root = root
+        self.sizes = sizes or DERIVATIVE_SIZES
+        self.quality = quality
+
+    @property
+    def draft_size(self):
+        # Decoding at the largest derivative size covers every smaller one
+        largest = max(self.sizes.values())
+        return (largest, largest)
+
+    def paths(self, digest):
+        return {name: f"{name}/{digest[:2]}/{digest}.jpg" for name in self.sizes}
+
+    def missing(self, digest):
+        return [name for name, path in self.paths(digest).items()
+                if not os.path.exists(os.path.join(self.root, path))]
+
+    def save(self, image, digest, names):
+        paths = self.paths(digest)
+        # Largest first, so each smaller size is resized from the previous one
+        for name in sorted(names, key=lambda n: -self.sizes[n]):
+            size = self.sizes[name]
+            image = image.copy()
+            image.thumbnail((size, size), Image.Resampling.LANCZOS)
+            full_path = os.path.join(self.root, paths[name])
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            # Several workers may write the same digest; the rename keeps readers from seeing partial files
+            tmp_path = f"{full_path}.{os.getpid()}.tmp"
+            image.save(tmp_path, "JPEG", quality=self.quality, optimize=True)
+            os.replace(tmp_path, full_path)
+        return paths
@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import numpy as np
+
+# Store of the 512-d pooled MultiTaskResNet features, written by
+# ML_initialize.py --embeddings, for "find similar frames" and picking labeling
+# candidates without running the network again.
+#
+# Vectors are L2-normalized and kept as float16 in a raw memory-mapped matrix
+# whose row number is Images.Id, so a lookup is an index and the file grows by
+# doubling as higher Ids arrive. A million frames take about 1 GB. Search is
+# exhaustive (chunked NumPy matrix products over the memmap), or with an IVF
+# index built by build_ivf() only the rows in the clusters nearest the query
+# are scored.
+
+EMBEDDING_DIM = 512
+SEARCH_CHUNK_ROWS = 65536
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+def top_k(ids, scores, k):
+    if len(scores) > k:
+        keep = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[keep], scores[keep]
+    order = np.argsort(-scores, kind="stable")
+    return ids[order], scores[order]
+
+class EmbeddingStore:
+    def __init__(self, path, model_version=None, dim=EMBEDDING_DIM, read_only=False):
+        self.path = path
+        self.read_only = read_only
+        meta_path = self._file("meta.json")
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                self.meta = json.load(f)
+            stored = self.meta.get("model_version")
+            if model_version and stored and stored != model_version and self.meta["capacity"]:
+                raise ValueError(f"{path} holds embeddings from model {stored[:12]}, not {model_version[:12]}; "
+                                 "use a new folder for the new model")
+        elif read_only:
+            raise FileNotFoundError(f"No embedding store in {path}")
+        else:
+            os.makedirs(path, exist_ok=True)
+            self.meta = {"dim": dim, "capacity": 0, "model_version": model_version}
+            self._write_meta()
+        if model_version and not self.meta.get("model_version") and not read_only:
+            self.meta["model_version"] = model_version
+            self._write_meta()
+
+        centroids_path = self._file("ivf_centroids.npy")
+        self.centroids = np.load(centroids_path) if os.path.exists(centroids_path) else None
+        self._map()
+
+    @property
+    def dim(self):
+        return self.meta["dim"]
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _write_meta(self):
+        with open(self._file("meta.json.tmp"), "w") as f:
+            json.dump(self.meta, f)
+        os.replace(self._file("meta.json.tmp"), self._file("meta.json"))
+
+    def _map(self):
+        # vectors: float16 rows; present: 1 where a row has been written;
+        # lists: IVF cluster + 1 per row, 0 when unassigned
+        capacity = self.meta["capacity"]
+        if capacity == 0:
+            self.vectors = np.zeros((0, self.dim), dtype=np.float16)
+            self.present = np.zeros(0, dtype=np.uint8)
+            self.lists = np.zeros(0, dtype=np.int32)
+            return
+        mode = "r" if self.read_only else "r+"
+        self.vectors = np.memmap(self._file("embeddings.f16"), dtype=np.float16, mode=mode, shape=(capacity, self.dim))
+        self.present = np.memmap(self._file("present.u8"), dtype=np.uint8, mode=mode, shape=(capacity,))
+        self.lists = np.memmap(self._file("ivf_lists.i32"), dtype=np.int32, mode=mode, shape=(capacity,))
+
+    def _grow(self, needed):
+        capacity = max(needed, self.meta["capacity"] * 2, 1024)
+        self.flush()
+        self.vectors = self.present = self.lists = None
+        # Extending the files zero-fills the new rows. Never shrink a file, so
+        # rows past this process's idea of the capacity are not lost.
+        for name, row_bytes in (("embeddings.f16", 2 * self.dim), ("present.u8", 1), ("ivf_lists.i32", 4)):
+            with open(self._file(name), "ab") as f:
+                if f.tell() < capacity * row_bytes:
+                    f.truncate(capacity * row_bytes)
+        self.meta["capacity"] = capacity
+        self._write_meta()
+        self._map()
+
+    def put(self, ids, vectors):
+        ids = np.asarray(ids, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        vectors = normalize(vectors)
+        if ids.max() >= self.meta["capacity"]:
+            self._grow(int(ids.max()) + 1)
+        self.vectors[ids] = vectors.astype(np.float16)
+        self.present[ids] = 1
+        if self.centroids is not None:
+            self.lists[ids] = np.argmax(vectors @ self.centroids.T, axis=1) + 1
+
+    def get(self, ids):
+        ids = np.asarray(ids, dtype=np.int64)
+        inside = ids < self.meta["capacity"]
+        found = np.zeros(len(ids), dtype=bool)
+        found[inside] = self.present[ids[inside]] == 1
+        vectors = np.zeros((len(ids), self.dim), dtype=np.float32)
+        vectors[found] = self.vectors[ids[found]]
+        return vectors, found
+
+    def __len__(self):
+        return int(np.count_nonzero(self.present))
+
+    def search(self, queries, k=10, probe=None):
+        # Returns one (ids, scores) pair per query, best cosine similarity first.
+        # With probe and an IVF index, only the probe nearest clusters are scored.
+        queries = normalize(queries).reshape(-1, self.dim)
+        if probe and self.centroids is not None:
+            nearest = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :probe] + 1
+            results = []
+            for query, lists in zip(queries, nearest):
+                candidates = np.flatnonzero(np.isin(self.lists, lists))
+                scores = self.vectors[candidates].astype(np.float32) @ query
+                results.append(top_k(candidates, scores, k))
+            return results
+
+        best = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)) for _ in queries]
+        for start in range(0, self.meta["capacity"], SEARCH_CHUNK_ROWS):
+            rows = np.flatnonzero(self.present[start:start + SEARCH_CHUNK_ROWS])
+            if len(rows) == 0:
+                continue
+            block = self.vectors[start:start + SEARCH_CHUNK_ROWS][rows].astype(np.float32)
+            scores = queries @ block.T
+            for i, (ids, best_scores) in enumerate(best):
+                best[i] = top_k(np.concatenate([ids, rows + start]), np.concatenate([best_scores, scores[i]]), k)
+        return best
+
+    def build_ivf(self, n_lists=1024, sample=200000, iterations=10, seed=0):
+        # Spherical k-means on a sample of rows, then every row is assigned to its nearest centroid
+        present = np.flatnonzero(self.present)
+        if len(present) == 0:
+            raise ValueError(f"No embeddings in {self.path} to cluster")
+        rng = np.random.default_rng(seed)
+        sample_ids = np.sort(rng.choice(present, size=min(sample, len(present)), replace=False))
+        data = self.vectors[sample_ids].astype(np.float32)
+        n_lists = min(n_lists, len(data))
+        centroids = data[rng.choice(len(data), n_lists, replace=False)]
+        for _ in range(iterations):
+            assign = self._nearest(data, centroids)
+            order = np.argsort(assign, kind="stable")
+            clusters, starts = np.unique(assign[order], return_index=True)
+            # Empty clusters keep their previous centroid
+            centroids[clusters] = normalize(np.add.reduceat(data[order], starts))
+
+        self.centroids = centroids
+        np.save(self._file("ivf_centroids.npy"), centroids)
+        for start in range(0, self.meta["capacity"], SEARCH_CHUNK_ROWS):
+            block = np.asarray(self.vectors[start:start + SEARCH_CHUNK_ROWS], dtype=np.float32)
+            lists = self._nearest(block, centroids) + 1
+            lists[self.present[start:start + SEARCH_CHUNK_ROWS] == 0] = 0
+            self.lists[start:start + len(block)] = lists
+        self.flush()
+        return n_lists
+
+    @staticmethod
+    def _nearest(data, centroids, chunk=16384):
+        # Chunked so the distance matrix stays small with many lists
+        nearest = np.zeros(len(data), dtype=np.int64)
+        for i in range(0, len(data), chunk):
+            nearest[i:i + chunk] = np.argmax(data[i:i + chunk] @ centroids.T, axis=1)
+        return nearest
+
+    def flush(self):
+        for array in (self.vectors, self.present, self.lists):
+            if isinstance(array, np.memmap) and not self.read_only:
+                array.flush()
+
+    def close(self):
+        self.flush()
+        self.vectors = self.present = self.lists = None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Search or index the image embedding store')
+    parser.add_argument('--store', type=str, default='embeddings', help='Embedding store folder')
+    parser.add_argument('--like', type=int, nargs='+', default=None, help='Image Ids to find similar frames for')
+    parser.add_argument('--k', type=int, default=10, help='Neighbours returned per Id')
+    parser.add_argument('--probe', type=int, default=None,
+                        help='Search only this many nearest IVF clusters (default: exhaustive)')
+    parser.add_argument('--build-ivf', type=int, default=None, metavar='LISTS',
+                        help='Cluster the store into this many IVF lists')
+
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store, read_only=not args.build_ivf)
+    print(f"{len(store)} embeddings in {args.store}")
+
+    if args.build_ivf:
+        lists = store.build_ivf(args.build_ivf)
+        print(f"Built an IVF index with {lists} lists.")
+
+    if args.like:
+        vectors, found = store.get(args.like)
+        for img_id, ok in zip(args.like, found):
+            if not ok:
+                print(f"Id {img_id} has no embedding")
+        queries = [img_id for img_id, ok in zip(args.like, found) if ok]
+        for img_id, (ids, scores) in zip(queries, store.search(vectors[found], k=args.k + 1, probe=args.probe)):
+            neighbours = [(int(i), float(s)) for i, s in zip(ids, scores) if i != img_id][:args.k]
+            print(f"Id {img_id}: " + ", ".join(f"{i} ({s:.3f})" for i, s in neighbours))
+    store.close()
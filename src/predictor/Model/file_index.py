@@ -0,0 +1,146 @@
+import argparse
+import csv
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# In-memory index of the image archive, so the prediction and copy scripts can
+# check that a file exists without a stat per row on the network mount.
+#
+# Each top-level (site) directory is walked with os.scandir on its own thread.
+# The index is cached to disk per directory with the directory's mtime; on the
+# next run a directory whose mtime is unchanged keeps its cached file list, so a
+# refresh costs one stat per directory instead of one per file.
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def scan_directory(path, cached):
+    # Returns {dir_path: {"mtime", "files": {name: [size, mtime]}, "dirs": [names]}}
+    # for path and everything under it, reusing cached entries that are unchanged
+    result = {}
+    pending = [path]
+    while pending:
+        current = pending.pop()
+        try:
+            mtime = os.stat(current).st_mtime
+        except OSError:
+            continue
+        entry = cached.get(current)
+        if entry is None or entry["mtime"] != mtime:
+            entry = {"mtime": mtime, "files": {}, "dirs": []}
+            try:
+                with os.scandir(current) as it:
+                    for item in it:
+                        if item.is_dir(follow_symlinks=False):
+                            entry["dirs"].append(item.name)
+                        elif item.name.lower().endswith(IMAGE_EXTENSIONS):
+                            stat = item.stat()
+                            entry["files"][item.name] = [stat.st_size, stat.st_mtime]
+            except OSError:
+                continue
+        result[current] = entry
+        pending.extend(os.path.join(current, name) for name in entry["dirs"])
+    return result
+
+class FileIndex:
+    def __init__(self, roots, cache_path=None, workers=16):
+        self.roots = [os.path.normpath(root) for root in ([roots] if isinstance(roots, str) else roots)]
+        self.cache_path = cache_path
+        self.workers = workers
+        self.directories = {}
+        self.files = {}
+
+    def refresh(self):
+        start = time.perf_counter()
+        cached = {}
+        if self.cache_path and os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+
+        # One task per site directory, plus the files sitting directly in each root
+        tops = []
+        for root in self.roots:
+            entry = {"mtime": None, "files": {}, "dirs": []}
+            try:
+                entry["mtime"] = os.stat(root).st_mtime
+                with os.scandir(root) as it:
+                    for item in it:
+                        if item.is_dir(follow_symlinks=False):
+                            tops.append(item.path)
+                        elif item.name.lower().endswith(IMAGE_EXTENSIONS):
+                            stat = item.stat()
+                            entry["files"][item.name] = [stat.st_size, stat.st_mtime]
+            except OSError as e:
+                print(f"Cannot scan {root}: {e}")
+                continue
+            self.directories[root] = entry
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for result in executor.map(lambda top: scan_directory(top, cached), tops):
+                self.directories.update(result)
+
+        self.files = {}
+        for directory, entry in self.directories.items():
+            for name, info in entry["files"].items():
+                self.files[os.path.join(directory, name)] = info
+
+        if self.cache_path:
+            # Shards may refresh the same cache at once; each writes its own temp file
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.directories, f)
+            os.replace(tmp_path, self.cache_path)
+        reused = sum(1 for directory, entry in self.directories.items() if cached.get(directory) is entry)
+        print(f"Indexed {len(self.files)} files in {len(self.directories)} directories "
+              f"({reused} unchanged) in {time.perf_counter() - start:.1f}s")
+        return self
+
+    def exists(self, path):
+        return os.path.normpath(path) in self.files
+
+    def missing(self, paths):
+        return [path for path in paths if not self.exists(path)]
+
+    def orphans(self, referenced):
+        referenced = {os.path.normpath(path) for path in referenced}
+        return sorted(path for path in self.files if path not in referenced)
+
+def write_csv(path, header, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+if __name__ == "__main__":
+    # Bulk report of rows whose file is missing and files no row points to
+    from db_connect import connect_to_database, stream_rows
+    from ML_initialize import resolve_image_path
+
+    parser = argparse.ArgumentParser(description='Index the image archive and report missing and orphaned files')
+    parser.add_argument('--root', nargs='+', required=True, help='Archive folders to index')
+    parser.add_argument('--base-path', type=str, default='/', help='Folder FilePath values are relative to')
+    parser.add_argument('--cache', type=str, default='file_index.json', help='Index cache file')
+    parser.add_argument('--workers', type=int, default=16, help='Directories scanned in parallel')
+    parser.add_argument('--missing', type=str, default='missing_files.csv', help='CSV of rows with no file')
+    parser.add_argument('--orphans', type=str, default='orphaned_files.csv', help='CSV of files with no row')
+
+    args = parser.parse_args()
+
+    index = FileIndex(args.root, args.cache, args.workers).refresh()
+
+    conn = connect_to_database()
+    referenced = set()
+    missing = []
+    for img_id, file_path in stream_rows(conn, ["Id", "FilePath"]):
+        real_path = resolve_image_path(file_path, args.base_path)
+        referenced.add(real_path)
+        if not index.exists(real_path):
+            missing.append((img_id, real_path))
+    conn.close()
+
+    orphans = index.orphans(referenced)
+    write_csv(args.missing, ["Id", "path"], missing)
+    write_csv(args.orphans, ["path"], ([path] for path in orphans))
+    print(f"{len(missing)} rows point to missing files ({args.missing}), "
+          f"{len(orphans)} files have no row ({args.orphans})")
@@ -0,0 +1,58 @@
+import hashlib
+import sqlite3
+from PIL import Image
+
+# Local prediction cache keyed by image content and model fingerprint, so
+# byte-identical files (re-imported archives, the same file under several
+# FilePaths) and, in perceptual mode, near-identical frames (stuck cameras)
+# are resolved by lookup instead of a forward pass. Stored in SQLite with WAL
+# so DataLoader workers can read while the main process writes.
+
+def content_hash(data):
+    return "sha256:" + hashlib.sha256(data).hexdigest()
+
+def perceptual_hash(image_file):
+    # 64-bit difference hash: compare neighbouring pixels of a 9x8 grayscale
+    # thumbnail. Draft mode keeps the decode for this tiny size cheap.
+    image = Image.open(image_file)
+    image.draft("L", (64, 64))
+    pixels = list(image.convert("L").resize((9, 8), Image.Resampling.BILINEAR).getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            bits = (bits << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"dhash:{bits:016x}"
+
+class PredictionCache:
+    def __init__(self, path, model_version):
+        self.model_version = model_version
+        self.conn = sqlite3.connect(path, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS predictions (
+                hash TEXT NOT NULL,
+                model TEXT NOT NULL,
+                weather TEXT,
+                weather_pct REAL,
+                snow TEXT,
+                snow_pct REAL,
+                PRIMARY KEY (hash, model)
+            )
+        """)
+        self.conn.commit()
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT weather, weather_pct, snow, snow_pct FROM predictions WHERE hash = ? AND model = ?",
+            (key, self.model_version)).fetchone()
+        return tuple(row) if row else None
+
+    def put_many(self, entries):
+        # entries are (key, (weather, weather_pct, snow, snow_pct))
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?, ?)",
+            [(key, self.model_version) + tuple(result) for key, result in entries])
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,165 @@
+# Per-site, per-camera, per-day prediction rollup and the indexes the
+# prediction filters need.
+#
+# ImagePredictionDaily holds one row per SiteName, SiteNumber,
+# CameraPositionNumber, Day, task (Weather or Snow) and predicted label, with
+# the image count and mean confidence. "Snow days per site" becomes a lookup on this table instead of a
+# scan of Images. ML_initialize.py keeps it current: each flush records the
+# days it touched and recomputes only those days from Images, in the same
+# transaction as the predictions. Rows without SiteName, SiteNumber,
+# CameraPositionNumber or DateTime are not rolled up.
+#
+# SiteNumber is the sub-site within a site (Sheep, Rockland and Snake all have a
+# site_1), so a camera is only identified together with SiteName. Images.SiteName
+# is NVARCHAR(MAX) and cannot be a key column, so the rollup keys on it cast to
+# NVARCHAR(100), and recomputes seek Images on SiteNumber and check SiteName on
+# the rows found.
+#
+# Sharded runs update Images concurrently, so the rollup is recomputed under
+# the ROLLUP_LOCK application lock, taken before a flush touches Images. Flushes
+# that maintain the rollup therefore run one at a time, and a recompute never
+# reads rows another shard has not committed yet.
+
+ROLLUP_TABLE = "ImagePredictionDaily"
+ROLLUP_LOCK = "ImagePredictionDaily.recompute"
+
+SITE_KEY = "CAST(i.SiteName AS NVARCHAR(100))"
+
+CREATE_ROLLUP_SQL = f"""
+CREATE TABLE {ROLLUP_TABLE} (
+    SiteName NVARCHAR(100) NOT NULL,
+    SiteNumber INT NOT NULL,
+    CameraPositionNumber INT NOT NULL,
+    Day DATE NOT NULL,
+    Task NVARCHAR(16) NOT NULL,
+    Label NVARCHAR(50) NOT NULL,
+    ImageCount INT NOT NULL,
+    MeanPercent FLOAT NULL,
+    PRIMARY KEY (SiteName, SiteNumber, CameraPositionNumber, Day, Task, Label)
+);
+"""
+
+CREATE_ROLLUP_DAYS_SQL = """
+IF OBJECT_ID('tempdb..#RollupDays') IS NOT NULL
+    DROP TABLE #RollupDays;
+CREATE TABLE #RollupDays (
+    SiteName NVARCHAR(100) NOT NULL,
+    SiteNumber INT NOT NULL,
+    CameraPositionNumber INT NOT NULL,
+    Day DATE NOT NULL,
+    PRIMARY KEY (SiteName, SiteNumber, CameraPositionNumber, Day)
+);
+"""
+
+# Run while #PredictionStaging still holds the flushed rows
+TOUCHED_DAYS_SQL = f"""
+INSERT INTO #RollupDays (SiteName, SiteNumber, CameraPositionNumber, Day)
+SELECT DISTINCT {SITE_KEY}, i.SiteNumber, i.CameraPositionNumber, CAST(i.DateTime AS DATE)
+FROM Images i
+JOIN #PredictionStaging s ON i.Id = s.Id
+WHERE i.SiteName IS NOT NULL AND i.SiteNumber IS NOT NULL AND i.CameraPositionNumber IS NOT NULL
+  AND i.DateTime IS NOT NULL;
+"""
+
+# The DateTime range join lets each day seek IX_Images_SiteCameraDateTime
+AGGREGATE_SQL = f"""
+SELECT {SITE_KEY}, i.SiteNumber, i.CameraPositionNumber, CAST(i.DateTime AS DATE), v.Task, v.Label,
+       COUNT(*), AVG(v.Pct)
+FROM {{source}}
+CROSS APPLY (VALUES ('Weather', i.WeatherPrediction, i.WeatherPredictionPercent),
+                    ('Snow', i.SnowPrediction, i.SnowPredictionPercent)) v(Task, Label, Pct)
+WHERE v.Label IS NOT NULL AND i.WeatherPrediction IS NOT NULL AND i.SiteName IS NOT NULL
+  AND i.SiteNumber IS NOT NULL AND i.CameraPositionNumber IS NOT NULL AND i.DateTime IS NOT NULL
+GROUP BY {SITE_KEY}, i.SiteNumber, i.CameraPositionNumber, CAST(i.DateTime AS DATE), v.Task, v.Label
+"""
+
+TOUCHED_ROWS = f"""#RollupDays d
+JOIN Images i ON i.SiteNumber = d.SiteNumber AND i.CameraPositionNumber = d.CameraPositionNumber
+             AND i.DateTime >= CAST(d.Day AS DATETIME2) AND i.DateTime < DATEADD(DAY, 1, CAST(d.Day AS DATETIME2))
+             AND {SITE_KEY} = d.SiteName"""
+
+RECOMPUTE_DAYS_SQL = f"""
+DELETE r
+FROM {ROLLUP_TABLE} r
+JOIN #RollupDays d ON r.SiteName = d.SiteName AND r.SiteNumber = d.SiteNumber
+                   AND r.CameraPositionNumber = d.CameraPositionNumber AND r.Day = d.Day;
+INSERT INTO {ROLLUP_TABLE} (SiteName, SiteNumber, CameraPositionNumber, Day, Task, Label, ImageCount, MeanPercent)
+{AGGREGATE_SQL.format(source=TOUCHED_ROWS)};
+TRUNCATE TABLE #RollupDays;
+"""
+
+BACKFILL_SQL = f"""
+INSERT INTO {ROLLUP_TABLE} (SiteName, SiteNumber, CameraPositionNumber, Day, Task, Label, ImageCount, MeanPercent)
+{AGGREGATE_SQL.format(source="Images i")};
+"""
+
+#   IX_Images_SiteCameraDateTime - rollup recomputes, and the api's site/camera/date
+#                                  filters (SiteName is NVARCHAR(MAX), so only
+#                                  included). Unfiltered, because the api filters
+#                                  on confidence, which does not imply a prediction.
+#   IX_Images_Predictions        - filtered to predicted rows: label filters
+#                                  ordered by DateTime, and copy_confident_images.py
+#                                  category selection
+PREDICTION_INDEXES = {
+    "IX_Images_SiteCameraDateTime": """
+        CREATE INDEX IX_Images_SiteCameraDateTime ON Images (SiteNumber, CameraPositionNumber, DateTime)
+        INCLUDE (SiteName, WeatherPrediction, WeatherPredictionPercent, SnowPrediction, SnowPredictionPercent)
+    """,
+    "IX_Images_Predictions": """
+        CREATE INDEX IX_Images_Predictions ON Images (WeatherPrediction, SnowPrediction, DateTime)
+        INCLUDE (WeatherPredictionPercent, SnowPredictionPercent, SiteName, CameraPositionNumber, FilePath)
+        WHERE WeatherPrediction IS NOT NULL
+    """
+}
+
+def set_index_session_options(cursor):
+    # Sessions that write to a table with filtered indexes need these on
+    cursor.execute("SET ANSI_NULLS ON; SET QUOTED_IDENTIFIER ON; SET ANSI_PADDING ON; "
+                   "SET ANSI_WARNINGS ON; SET ARITHABORT ON; SET CONCAT_NULL_YIELDS_NULL ON; "
+                   "SET NUMERIC_ROUNDABORT OFF;")
+
+def lock_rollup(cursor):
+    # Held until the flush commits; call before the flush updates Images
+    cursor.execute("EXEC sp_getapplock @Resource = %s, @LockMode = 'Exclusive', "
+                   "@LockOwner = 'Transaction', @LockTimeout = -1", (ROLLUP_LOCK,))
+
+def ensure_rollup(conn):
+    # Creates the rollup table on first use and fills it from every predicted row.
+    # Call under schema_lock() so concurrent shards do not both create it.
+    cursor = conn.cursor()
+    cursor.execute("SELECT OBJECT_ID(%s), COL_LENGTH(%s, 'SiteName')", (ROLLUP_TABLE, ROLLUP_TABLE))
+    table_id, site_name_bytes = cursor.fetchone()
+    created = table_id is None
+    if not created and site_name_bytes != 200:
+        # Built by an earlier version keyed without SiteName; it is derived, so rebuild it
+        print(f"Rebuilding {ROLLUP_TABLE} keyed on SiteName and SiteNumber...")
+        cursor.execute(f"DROP TABLE {ROLLUP_TABLE}")
+        created = True
+    if created:
+        print(f"Creating {ROLLUP_TABLE} from existing predictions...")
+        cursor.execute(CREATE_ROLLUP_SQL)
+        cursor.execute(BACKFILL_SQL)
+        conn.commit()
+    cursor.close()
+    return created
+
+def ensure_prediction_indexes(conn):
+    # Call under schema_lock(), like ensure_rollup()
+    cursor = conn.cursor()
+    created = []
+    for name, sql in PREDICTION_INDEXES.items():
+        cursor.execute("SELECT has_filter FROM sys.indexes WHERE name = %s AND object_id = OBJECT_ID('Images')",
+                       (name,))
+        existing = cursor.fetchone()
+        if existing is not None and bool(existing[0]) != ("WHERE" in sql):
+            # An earlier version created it with a different filter
+            print(f"Rebuilding index {name}...")
+            cursor.execute(f"DROP INDEX {name} ON Images")
+            existing = None
+        if existing is None:
+            print(f"Creating index {name}...")
+            cursor.execute(sql)
+            conn.commit()
+            created.append(name)
+    cursor.close()
+    return created
@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from classify_images import load_model
+
+# Long-lived prediction service. The model stays loaded, each request thread
+# decodes its own images, and a single batcher thread collects the tensors
+# from concurrent requests into one forward pass.
+#
+#   POST /predict  {"path": "..."} or {"paths": ["...", ...]}
+#   GET  /health
+
+class MicroBatcher:
+    def __init__(self, predictor, max_batch=32, window_ms=10):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self.pending = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, image_tensor):
+        future = Future()
+        self.pending.put((image_tensor, future))
+        return future
+
+    def _run(self):
+        while True:
+            # Block for the first item, then keep collecting until the window
+            # closes or the batch is full
+            batch = [self.pending.get()]
+            deadline = time.perf_counter() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.pending.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            tensors = [image_tensor for image_tensor, _ in batch]
+            try:
+                results = self.predictor.predict_batch(tensors)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    batcher = None
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        else:
+            self._send_json(404, {"error": "Not found"})
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send_json(404, {"error": "Not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            paths = body["paths"] if "paths" in body else [body["path"]]
+            if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                raise TypeError("paths must be a list of strings and path a string")
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"Expected {{\"path\": ...}} or {{\"paths\": [...]}}: {e}"})
+            return
+
+        start = time.perf_counter()
+        submitted = []
+        for image_path in paths:
+            try:
+                submitted.append((image_path, self.batcher.submit(self.batcher.predictor.preprocess(image_path))))
+            except Exception as e:
+                submitted.append((image_path, str(e)))
+
+        results = []
+        for image_path, future in submitted:
+            if isinstance(future, str):
+                results.append({"path": image_path, "error": future})
+                continue
+            try:
+                result = future.result()
+                result["path"] = image_path
+                result["latency_ms"] = (time.perf_counter() - start) * 1000
+                results.append(result)
+            except Exception as e:
+                results.append({"path": image_path, "error": str(e)})
+
+        self._send_json(200, {"results": results})
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve snow predictions over HTTP with a resident model')
+    parser.add_argument('--model', type=str, default='best_model.pth', help='Path to the model file')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8765, help='Port to listen on')
+    parser.add_argument('--max-batch', type=int, default=32, help='Largest batch run in one forward pass')
+    parser.add_argument('--window-ms', type=float, default=10, help='How long to wait for more requests before running a batch')
+
+    args = parser.parse_args()
+
+    if not os.path.exists(args.model):
+        print(f"Error: Model file not found at {args.model}")
+        exit(1)
+
+    PredictionHandler.batcher = MicroBatcher(load_model(args.model), max_batch=args.max_batch, window_ms=args.window_ms)
+    server = ThreadingHTTPServer((args.host, args.port), PredictionHandler)
+    print(f"Serving predictions on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,367 @@
+import os
+import hashlib
+import threading
+import torch
+from torchvision import transforms, models
+from PIL import Image
+
+# Shared predictor core used by ML_initialize.py, data_labeling_model.py,
+# classify_images.py, prediction_service.py and GUI_to_Test.py. Importing this
+# module loads no weights; models are built and loaded on first use and cached
+# per file.
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+# --- Model Definitions ---
+class MultiTaskResNet(torch.nn.Module):
+    def __init__(self, pretrained=False):
+        super(MultiTaskResNet, self).__init__()
+        self.base_model = models.resnet34(pretrained=pretrained)
+
+        for param in self.base_model.parameters():
+            param.requires_grad = False
+        for param in self.base_model.layer4.parameters():
+            param.requires_grad = True
+
+        self.features = torch.nn.Sequential(*list(self.base_model.children())[:-1])
+
+        self.weather_classifier = torch.nn.Sequential(
+            torch.nn.Dropout(0.5),
+            torch.nn.Linear(512, 256),
+            torch.nn.ReLU(),
+            torch.nn.Dropout(0.3),
+            torch.nn.Linear(256, 2)
+        )
+
+        self.snow_classifier = torch.nn.Sequential(
+            torch.nn.Dropout(0.5),
+            torch.nn.Linear(512, 256),
+            torch.nn.ReLU(),
+            torch.nn.Dropout(0.3),
+            torch.nn.Linear(256, 2)
+        )
+
+    def embed(self, x):
+        # 512-d pooled features shared by both heads
+        return torch.flatten(self.features(x), 1)
+
+    def classify(self, x):
+        return self.weather_classifier(x), self.snow_classifier(x)
+
+    def forward(self, x):
+        return self.classify(self.embed(x))
+
+def build_snow_binary():
+    model = models.resnet34(pretrained=False)
+    model.fc = torch.nn.Sequential(
+        torch.nn.Linear(model.fc.in_features, 2)
+    )
+    return model
+
+def build_weather4():
+    model = models.resnet34(pretrained=False)
+    model.fc = torch.nn.Sequential(
+        torch.nn.Dropout(0.5),
+        torch.nn.Linear(model.fc.in_features, 512),
+        torch.nn.ReLU(),
+        torch.nn.Dropout(0.3),
+        torch.nn.Linear(512, 4)
+    )
+    return model
+
+# --- Postprocessing ---
+WEATHER_LABELS = ['Sunny', 'Cloudy']
+SNOW_LABELS = ['No Snow', 'Snow']
+
+def postprocess_multitask(outputs):
+    weather_out, snow_out = outputs
+    weather_probs = torch.softmax(weather_out, dim=1)
+    snow_probs = torch.softmax(snow_out, dim=1)
+    weather_conf, weather_idx = weather_probs.max(dim=1)
+    snow_conf, snow_idx = snow_probs.max(dim=1)
+
+    results = []
+    for w_idx, w_conf, s_idx, s_conf in zip(weather_idx.tolist(), weather_conf.tolist(),
+                                            snow_idx.tolist(), snow_conf.tolist()):
+        results.append({
+            "weather": WEATHER_LABELS[w_idx],
+            "weather_prob": w_conf,
+            "snow": SNOW_LABELS[s_idx],
+            "snow_prob": s_conf
+        })
+    return results
+
+def postprocess_snow_binary(outputs):
+    results = []
+    for has_snow_prob, no_snow_prob in torch.sigmoid(outputs).tolist():
+        results.append({
+            "prediction": 'Has Snow' if has_snow_prob > no_snow_prob else 'No Snow',
+            "snow_prob": has_snow_prob,
+            "no_snow_prob": no_snow_prob
+        })
+    return results
+
+def postprocess_weather4(outputs):
+    results = []
+    for sunny_snow, cloudy_snow, sunny_no_snow, cloudy_no_snow in torch.softmax(outputs, dim=1).tolist():
+        snow_prob = sunny_snow + cloudy_snow
+        no_snow_prob = sunny_no_snow + cloudy_no_snow
+        sunny_prob = sunny_snow + sunny_no_snow
+        cloudy_prob = cloudy_snow + cloudy_no_snow
+
+        conditions = ["Sunny" if sunny_prob > cloudy_prob else "Cloudy",
+                      "with Snow" if snow_prob > no_snow_prob else "No Snow"]
+        results.append({
+            "prediction": " ".join(conditions),
+            "confidence": max(sunny_snow, cloudy_snow, sunny_no_snow, cloudy_no_snow),
+            "snow_prob": snow_prob,
+            "no_snow_prob": no_snow_prob
+        })
+    return results
+
+# --- Preprocessing ---
+# Images are decoded straight to roughly the model's input size with PIL's JPEG
+# draft mode, which downscales in the DCT domain instead of decoding every
+# full-resolution pixel. Transforms stop at uint8 tensors (a quarter of the
+# size to pass between DataLoader workers), and mean/std normalization is
+# applied once per batch, in place, by normalize_batch().
+def open_image(image, draft_size=None):
+    # Paths and open binary files are decoded here; PIL images are used as is
+    if isinstance(image, (str, os.PathLike)) or hasattr(image, "read"):
+        image = Image.open(image)
+        if draft_size:
+            # Picks the largest JPEG scale that keeps both sides >= draft_size
+            image.draft("RGB", draft_size)
+    return image.convert("RGB")
+
+def preprocess_image(image, transform, draft_size=None):
+    return transform(open_image(image, draft_size))
+
+_mean_255 = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1) * 255
+_std_255 = torch.tensor(IMAGENET_STD).view(1, 3, 1, 1) * 255
+
+def normalize_batch(batch):
+    # uint8 batches are normalized here; float batches are assumed normalized
+    if batch.dtype != torch.uint8:
+        return batch
+    batch = batch.float()
+    batch.sub_(_mean_255.to(batch.device)).div_(_std_255.to(batch.device))
+    return batch
+
+# --- Model Registry ---
+# Each architecture has its own constructor, the preprocessing it was trained
+# with, and a postprocess step turning raw outputs into result dicts.
+MODEL_REGISTRY = {
+    "multitask": {
+        "build": MultiTaskResNet,
+        "draft_size": (256, 256),
+        "transform": transforms.Compose([
+            transforms.Resize((256, 256)),
+            transforms.CenterCrop(224),
+            transforms.PILToTensor()
+        ]),
+        "postprocess": postprocess_multitask
+    },
+    "snow_binary": {
+        "build": build_snow_binary,
+        "draft_size": (224, 224),
+        "transform": transforms.Compose([
+            transforms.Resize((224, 224)),
+            transforms.PILToTensor()
+        ]),
+        "postprocess": postprocess_snow_binary
+    },
+    "weather4": {
+        "build": build_weather4,
+        "draft_size": (224, 224),
+        "transform": transforms.Compose([
+            transforms.Resize((224, 224)),
+            transforms.PILToTensor()
+        ]),
+        "postprocess": postprocess_weather4
+    }
+}
+
+# --- Device Selection ---
+def get_best_device():
+    if torch.cuda.is_available():
+        print(f"Using CUDA GPU: {torch.cuda.get_device_name(0)}")
+        return torch.device("cuda:0")
+    elif hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
+        print("Using Apple Metal (MPS) GPU")
+        return torch.device("mps")
+    elif torch.version.hip is not None and torch.cuda.is_available():
+        print("Using ROCm-compatible AMD GPU")
+        return torch.device("cuda:0")
+    else:
+        print("No GPU available. Falling back to CPU.")
+        return torch.device("cpu")
+
+# --- Model Fingerprint ---
+# Hash of the weights, stored next to every prediction so rows produced by an
+# older best_model.pth can be found and re-predicted after retraining.
+def model_fingerprint(state_dict):
+    digest = hashlib.sha256()
+    for key in sorted(state_dict):
+        digest.update(key.encode("utf-8"))
+        digest.update(state_dict[key].detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+# --- Model Files ---
+# Model files are either a bare state_dict (older best_model.pth files) or an
+# exported artifact written by data_labeling_model.py: the state_dict plus the
+# architecture, its fingerprint and the class labels it was trained with.
+CLASS_LABELS = {"weather": WEATHER_LABELS, "snow": SNOW_LABELS}
+
+def export_model(model, path, arch="multitask", **metadata):
+    state_dict = {key: value.detach().cpu().contiguous() for key, value in model.state_dict().items()}
+    artifact = {
+        "arch": arch,
+        "fingerprint": model_fingerprint(state_dict),
+        "labels": CLASS_LABELS if arch == "multitask" else None,
+        "state_dict": state_dict,
+        **metadata
+    }
+    torch.save(artifact, path + ".tmp")
+    os.replace(path + ".tmp", path)
+    return artifact["fingerprint"]
+
+def load_model_file(model_path, arch=None, map_location=None):
+    # Returns (state_dict, metadata); metadata is empty for bare state_dicts
+    loaded = torch.load(model_path, map_location=map_location)
+    if "state_dict" not in loaded:
+        return loaded, {}
+    state_dict = loaded["state_dict"]
+    metadata = {key: value for key, value in loaded.items() if key != "state_dict"}
+    if arch is not None and metadata.get("arch", arch) != arch:
+        raise ValueError(f"{model_path} holds a {metadata['arch']} model, not {arch}")
+    if metadata.get("labels") and metadata["labels"] != CLASS_LABELS:
+        raise ValueError(f"{model_path} was trained with labels {metadata['labels']}, expected {CLASS_LABELS}")
+    if metadata.get("fingerprint") and metadata["fingerprint"] != model_fingerprint(state_dict):
+        raise ValueError(f"{model_path} does not match its recorded fingerprint; the file may be corrupt")
+    return state_dict, metadata
+
+def list_images(folder, limit=None):
+    paths = []
+    for dirpath, _, filenames in os.walk(folder):
+        for fname in sorted(filenames):
+            if fname.lower().endswith((".jpg", ".jpeg", ".png")):
+                paths.append(os.path.join(dirpath, fname))
+    paths.sort()
+    return paths[:limit] if limit else paths
+
+# --- Inference Backends ---
+# Alternatives to the fp32 eager model for CPU-only hosts. All of them return
+# outputs in the same form as the eager model, so postprocessing is shared.
+#   eager        - the model as trained
+#   int8-dynamic - dynamic int8 quantization of the Linear layers
+#   int8-static  - FX graph mode static int8 quantization, calibrated on sample images
+#   torchscript  - traced, frozen and optimized TorchScript module
+#   onnx         - ONNX export run with onnxruntime (optional dependency)
+BACKENDS = ["eager", "int8-dynamic", "int8-static", "torchscript", "onnx"]
+
+class OnnxModule:
+    def __init__(self, onnx_path):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("The onnx backend needs onnxruntime: pip install onnxruntime")
+        self.session = onnxruntime.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x):
+        outputs = [torch.from_numpy(out) for out in self.session.run(None, {self.input_name: x.numpy()})]
+        return tuple(outputs) if len(outputs) > 1 else outputs[0]
+
+def apply_backend(model, backend, onnx_path=None, calibration=None):
+    example = torch.randn(1, 3, 224, 224)
+
+    if backend == "eager":
+        return model
+    if backend == "int8-dynamic":
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == "int8-static":
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+        if not calibration:
+            raise ValueError("The int8-static backend needs calibration images")
+        prepared = prepare_fx(model, get_default_qconfig_mapping("x86"), (example,))
+        with torch.no_grad():
+            for batch in calibration:
+                prepared(batch)
+        return convert_fx(prepared)
+    if backend == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    if backend == "onnx":
+        if not os.path.exists(onnx_path):
+            torch.onnx.export(model, example, onnx_path, input_names=["image"],
+                              dynamic_axes={"image": {0: "batch"}}, opset_version=17)
+        return OnnxModule(onnx_path)
+    raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+
+# --- Predictor ---
+class Predictor:
+    def __init__(self, model_path, arch="multitask", device=None, backend="eager", calibration_images=None):
+        spec = MODEL_REGISTRY[arch]
+        self.model_path = model_path
+        self.arch = arch
+        self.device = device or torch.device("cpu")
+        self.backend = backend
+        self.transform = spec["transform"]
+        self.draft_size = spec["draft_size"]
+        self.postprocess = spec["postprocess"]
+        if backend != "eager" and self.device.type != "cpu":
+            raise ValueError(f"The {backend} backend only runs on CPU")
+
+        state_dict, self.metadata = load_model_file(model_path, arch, map_location=self.device)
+        self.fingerprint = self.metadata.get("fingerprint") or model_fingerprint(state_dict)
+        self.model = spec["build"]()
+        self.model.load_state_dict(state_dict)
+        self.model.to(self.device)
+        self.model.eval()
+
+        calibration = None
+        if calibration_images:
+            calibration = [normalize_batch(torch.stack([self.preprocess(image)
+                                                        for image in calibration_images[i:i + 32]]))
+                           for i in range(0, len(calibration_images), 32)]
+        # The exported ONNX file is tied to the weights it came from
+        onnx_path = f"{os.path.splitext(model_path)[0]}.{self.fingerprint[:12]}.onnx"
+        self.model = apply_backend(self.model, backend, onnx_path=onnx_path, calibration=calibration)
+
+    def preprocess(self, image):
+        return preprocess_image(image, self.transform, self.draft_size)
+
+    @property
+    def supports_embeddings(self):
+        # Traced, exported and FX-quantized backends only expose the final outputs
+        return hasattr(self.model, "embed")
+
+    def predict_batch(self, images, return_embeddings=False):
+        # images may be paths, PIL images, preprocessed tensors or a stacked batch.
+        # With return_embeddings, also returns the pooled features as a CPU tensor.
+        if not isinstance(images, torch.Tensor):
+            images = torch.stack([image if isinstance(image, torch.Tensor) else self.preprocess(image)
+                                  for image in images])
+        with torch.no_grad():
+            batch = normalize_batch(images.to(self.device))
+            if not return_embeddings:
+                return self.postprocess(self.model(batch))
+            if not self.supports_embeddings:
+                raise ValueError(f"Embeddings need the {self.arch} model on the eager or int8-dynamic backend")
+            embeddings = self.model.embed(batch)
+            outputs = self.model.classify(embeddings)
+        return self.postprocess(outputs), embeddings.float().cpu()
+
+_predictors = {}
+_predictors_lock = threading.Lock()
+
+def load_predictor(model_path, arch="multitask", device=None, backend="eager", calibration_images=None):
+    key = (os.path.abspath(model_path), arch, str(device or "cpu"), backend)
+    with _predictors_lock:
+        if key not in _predictors:
+            _predictors[key] = Predictor(model_path, arch, device, backend, calibration_images)
+        return _predictors[key]
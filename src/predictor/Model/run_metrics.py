@@ -0,0 +1,116 @@
+import json
+import os
+import time
+
+# Per-stage metrics for long prediction runs. Stage times, counters, gauges and
+# error counts are accumulated in memory and emitted every few seconds as one
+# JSON line, and optionally as a Prometheus text file (for the node_exporter
+# textfile collector), with running throughput and ETA.
+
+class RunMetrics:
+    def __init__(self, total, jsonl_path=None, prom_path=None, interval=30, labels=None):
+        self.total = total
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.interval = interval
+        self.labels = labels or {}
+        self.start = time.perf_counter()
+        self.last_emit = self.start
+        self.processed = 0
+        self.failed = 0
+        self.stage_seconds = {}
+        self.stage_counts = {}
+        self.gauges = {}
+        self.errors = {}
+        self.jsonl = open(jsonl_path, "a") if jsonl_path else None
+
+    def add_time(self, stage, seconds, count=1):
+        self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+        self.stage_counts[stage] = self.stage_counts.get(stage, 0) + count
+
+    def set_gauge(self, name, value):
+        self.gauges[name] = value
+
+    def error(self, kind):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+        self.failed += 1
+
+    def done(self, count):
+        self.processed += count
+
+    def snapshot(self):
+        elapsed = time.perf_counter() - self.start
+        handled = self.processed + self.failed
+        rate = self.processed / elapsed if elapsed > 0 else 0.0
+        remaining = max(self.total - handled, 0) if self.total is not None else None
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            **self.labels,
+            "elapsed_s": round(elapsed, 1),
+            "processed": self.processed,
+            "failed": self.failed,
+            "total": self.total,
+            "images_per_sec": round(rate, 2),
+            "eta_s": round(remaining / rate, 1) if rate > 0 and remaining is not None else None,
+            # Average milliseconds per item for each stage
+            "stage_ms": {stage: round(seconds * 1000 / max(self.stage_counts[stage], 1), 3)
+                         for stage, seconds in self.stage_seconds.items()},
+            "stage_total_s": {stage: round(seconds, 3) for stage, seconds in self.stage_seconds.items()},
+            "gauges": dict(self.gauges),
+            "errors": dict(self.errors)
+        }
+
+    def maybe_emit(self):
+        if time.perf_counter() - self.last_emit >= self.interval:
+            self.emit()
+
+    def emit(self):
+        self.last_emit = time.perf_counter()
+        snapshot = self.snapshot()
+        if self.jsonl:
+            self.jsonl.write(json.dumps(snapshot) + "\n")
+            self.jsonl.flush()
+        if self.prom_path:
+            self._write_prometheus(snapshot)
+        return snapshot
+
+    def close(self):
+        snapshot = self.emit()
+        if self.jsonl:
+            self.jsonl.close()
+        return snapshot
+
+    def _write_prometheus(self, snapshot):
+        base = ",".join(f'{key}="{value}"' for key, value in self.labels.items())
+
+        def labels(**extra):
+            parts = [base] if base else []
+            parts += [f'{key}="{value}"' for key, value in extra.items()]
+            return "{" + ",".join(parts) + "}" if parts else ""
+
+        lines = [
+            "# TYPE predictor_images_processed_total counter",
+            f"predictor_images_processed_total{labels()} {snapshot['processed']}",
+            "# TYPE predictor_images_failed_total counter",
+            f"predictor_images_failed_total{labels()} {snapshot['failed']}",
+            "# TYPE predictor_images_per_second gauge",
+            f"predictor_images_per_second{labels()} {snapshot['images_per_sec']}",
+        ]
+        if snapshot["total"] is not None:
+            lines += ["# TYPE predictor_images gauge", f"predictor_images{labels()} {snapshot['total']}"]
+        if snapshot["eta_s"] is not None:
+            lines += ["# TYPE predictor_eta_seconds gauge", f"predictor_eta_seconds{labels()} {snapshot['eta_s']}"]
+        lines.append("# TYPE predictor_stage_seconds_total counter")
+        for stage, seconds in snapshot["stage_total_s"].items():
+            lines.append(f"predictor_stage_seconds_total{labels(stage=stage)} {seconds}")
+        lines.append("# TYPE predictor_gauge gauge")
+        for name, value in snapshot["gauges"].items():
+            lines.append(f"predictor_gauge{labels(name=name)} {value}")
+        lines.append("# TYPE predictor_errors_total counter")
+        for kind, count in snapshot["errors"].items():
+            lines.append(f"predictor_errors_total{labels(type=kind)} {count}")
+
+        tmp_path = self.prom_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prom_path)
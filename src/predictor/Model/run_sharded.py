@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Coordinator for sharded full-archive runs. Launches one ML_initialize.py
+# process per local shard, each taking the rows with Id % shard-count equal to
+# its shard index and its own share of the CPU threads, and reports combined
+# progress from the shards' metrics files.
+#
+# To spread a run across machines, give every machine the same --shard-count
+# and a disjoint --shards range, e.g. "0-3" on one box and "4-7" on another.
+# With --watch, progress from other machines can be followed by pointing
+# --metrics-dir at a shared folder they all write to.
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ML_initialize.py")
+
+def parse_shards(value, shard_count):
+    shards = []
+    for part in value.split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            shards.extend(range(int(first), int(last) + 1))
+        else:
+            shards.append(int(part))
+    for shard in shards:
+        if not 0 <= shard < shard_count:
+            raise ValueError(f"Shard {shard} is outside 0-{shard_count - 1}")
+    return shards
+
+def shard_file(path, suffix):
+    # missing_files.csv -> missing_files.shard0of8.csv
+    root, ext = os.path.splitext(path)
+    return f"{root}.{suffix}{ext}"
+
+def metrics_path(metrics_dir, shard, shard_count):
+    return os.path.join(metrics_dir, f"initialize_metrics.shard{shard}of{shard_count}.jsonl")
+
+def read_last_line(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(size - 8192, 0))
+        lines = f.read().splitlines()
+    for line in reversed(lines):
+        try:
+            return json.loads(line)
+        except ValueError:
+            continue
+    return None
+
+def combined_progress(paths):
+    snapshots = [snapshot for snapshot in (read_last_line(path) for path in paths) if snapshot]
+    processed = sum(snapshot["processed"] for snapshot in snapshots)
+    failed = sum(snapshot["failed"] for snapshot in snapshots)
+    total = sum(snapshot["total"] or 0 for snapshot in snapshots)
+    rate = sum(snapshot["images_per_sec"] for snapshot in snapshots)
+    remaining = max(total - processed - failed, 0)
+    eta = remaining / rate if rate > 0 else None
+    return {
+        "shards_reporting": len(snapshots),
+        "processed": processed,
+        "failed": failed,
+        "total": total,
+        "images_per_sec": round(rate, 2),
+        "eta_s": round(eta, 1) if eta is not None else None
+    }
+
+def print_progress(progress, shard_total):
+    eta = f"{progress['eta_s'] / 60:.1f} min" if progress["eta_s"] is not None else "unknown"
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {progress['shards_reporting']}/{shard_total} shards reporting: "
+          f"{progress['processed']}/{progress['total']} predicted, {progress['failed']} failed, "
+          f"{progress['images_per_sec']:.1f} images/sec, ETA {eta}", flush=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run ML_initialize.py as several shards and report combined progress',
+                                     epilog='Any other options are passed through to ML_initialize.py')
+    parser.add_argument('--shard-count', type=int, required=True, help='Total number of shards across all machines')
+    parser.add_argument('--shards', type=str, default=None,
+                        help='Shards to run on this machine, e.g. "0-3" or "0,2" (default: all)')
+    parser.add_argument('--threads', type=int, default=None,
+                        help='torch threads per shard (default: CPU cores divided by local shards)')
+    parser.add_argument('--num-workers', type=int, default=2, help='Decoding workers per shard')
+    parser.add_argument('--metrics-dir', type=str, default='.', help='Folder for per-shard logs, checkpoints and metrics')
+    parser.add_argument('--missing-report', type=str, default='missing_files.csv',
+                        help='Missing-files CSV name; each shard writes its own copy in --metrics-dir')
+    parser.add_argument('--metrics-prom', type=str, default=None,
+                        help='Prometheus text file; each shard writes its own, named per shard')
+    parser.add_argument('--interval', type=float, default=30, help='Seconds between progress reports')
+    parser.add_argument('--watch', action='store_true',
+                        help='Only report progress from the metrics files of all shards, without launching any')
+
+    args, passthrough = parser.parse_known_args()
+
+    all_paths = [metrics_path(args.metrics_dir, shard, args.shard_count) for shard in range(args.shard_count)]
+
+    if args.watch:
+        while True:
+            progress = combined_progress(all_paths)
+            print_progress(progress, args.shard_count)
+            # Shards on other machines may not have written a snapshot yet
+            if progress["shards_reporting"] == args.shard_count and progress["total"] and progress["eta_s"] == 0:
+                break
+            time.sleep(args.interval)
+        sys.exit(0)
+
+    shards = parse_shards(args.shards, args.shard_count) if args.shards else list(range(args.shard_count))
+    threads = args.threads or max(1, (os.cpu_count() or 1) // len(shards))
+    os.makedirs(args.metrics_dir, exist_ok=True)
+
+    processes = {}
+    for shard in shards:
+        suffix = f"shard{shard}of{args.shard_count}"
+        command = [sys.executable, SCRIPT,
+                   "--shard-index", str(shard), "--shard-count", str(args.shard_count),
+                   "--threads", str(threads), "--num-workers", str(args.num_workers),
+                   "--log", os.path.join(args.metrics_dir, f"initialize.{suffix}.log"),
+                   "--checkpoint", os.path.join(args.metrics_dir, f"initialize.{suffix}.checkpoint"),
+                   "--metrics", metrics_path(args.metrics_dir, shard, args.shard_count),
+                   "--missing-report", os.path.join(args.metrics_dir, shard_file(args.missing_report, suffix)),
+                   "--metrics-interval", str(min(args.interval, 10))]
+        if args.metrics_prom:
+            command += ["--metrics-prom", shard_file(args.metrics_prom, suffix)]
+        command += passthrough
+        processes[shard] = subprocess.Popen(command)
+    print(f"Started {len(shards)} shards of {args.shard_count} with {threads} torch threads each.", flush=True)
+
+    local_paths = [metrics_path(args.metrics_dir, shard, args.shard_count) for shard in shards]
+    while any(process.poll() is None for process in processes.values()):
+        time.sleep(args.interval)
+        print_progress(combined_progress(local_paths), len(shards))
+
+    print_progress(combined_progress(local_paths), len(shards))
+    failed = [shard for shard, process in processes.items() if process.returncode != 0]
+    if failed:
+        print(f"Shards {failed} exited with errors; rerun them with --resume to continue.")
+        sys.exit(1)
+    print("All shards complete.")